@@ -23,6 +23,68 @@ class PINN(nn.Module):
         x = self.fc4(x)
         return x
 
+    def forward_laplacian(self, x):
+        """
+        前向拉普拉斯传播：一次前向计算同时得到 φ、∇φ 和 ∇²φ
+        
+        逐层传播值 h、雅可比 J = ∂h/∂x 和拉普拉斯 Δh：
+            线性层 z = hWᵀ + b:  J_z = J Wᵀ,  Δz = Δh Wᵀ
+            tanh 层 h = tanh(z):  J_h = h'·J_z,  Δh = h'·Δz + h''·Σᵢ(J_z)ᵢ²
+        其中 h' = 1 - h²，h'' = -2h·h'。结果与自动微分的结果严格相等，
+        但不需要 create_graph 的多次反向传播。
+        
+        参数:
+            x: 空间坐标 (batch_size, 3)，无需 requires_grad
+        
+        返回:
+            (phi, grad_phi, laplacian_phi)，形状分别为
+            (batch_size, 1)、(batch_size, 3)、(batch_size,)
+        """
+        # 第一层：J_z = W₁ᵀ 对所有点相同，Δz = 0
+        z = self.fc1(x)
+        jac_z = self.fc1.weight.t()                        # (3, hidden)
+        h = torch.tanh(z)
+        d1 = 1 - h**2
+        lap = -2 * h * d1 * (jac_z**2).sum(0)              # (N, hidden)
+        jac = d1.unsqueeze(1) * jac_z                      # (N, 3, hidden)
+        for fc in (self.fc2, self.fc3):
+            z = fc(h)
+            jac_z = jac @ fc.weight.t()
+            lap_z = lap @ fc.weight.t()
+            h = torch.tanh(z)
+            d1 = 1 - h**2
+            lap = d1 * lap_z - 2 * h * d1 * (jac_z**2).sum(1)
+            jac = d1.unsqueeze(1) * jac_z
+        phi = self.fc4(h)
+        grad_phi = (jac @ self.fc4.weight.t()).squeeze(-1)
+        laplacian_phi = (lap @ self.fc4.weight.t()).squeeze(-1)
+        return phi, grad_phi, laplacian_phi
+
+
+class HardConstraintPINN(PINN):
+    """硬约束边界的物理信息神经网络：φ = (1-x²)(1-y²)(1-z²)·N(r)"""
+    def forward(self, x):
+        return boundary_factor(x).unsqueeze(-1) * super().forward(x)
+
+    def forward_laplacian(self, x):
+        """前向拉普拉斯传播（硬约束版本）：∇²φ = g∇²N + 2∇g·∇N + N∇²g"""
+        n, grad_n, laplacian_n = super().forward_laplacian(x)
+        n = n.squeeze(-1)
+        s = 1 - x**2
+        g = s.prod(1)
+        others = torch.stack([s[:, 1] * s[:, 2], s[:, 0] * s[:, 2], s[:, 0] * s[:, 1]], dim=1)
+        grad_g = -2 * x * others
+        laplacian_g = -2 * others.sum(1)
+        phi = g * n
+        grad_phi = g.unsqueeze(-1) * grad_n + n.unsqueeze(-1) * grad_g
+        laplacian_phi = g * laplacian_n + 2 * (grad_g * grad_n).sum(1) + n * laplacian_g
+        return phi.unsqueeze(-1), grad_phi, laplacian_phi
+
+
+def boundary_factor(r):
+    """硬约束因子 g(r) = (1-x²)(1-y²)(1-z²)"""
+    return (1 - r**2).prod(1)
+
 
 def charge_distribution(r):
     """电荷分布"""
@@ -30,26 +92,8 @@ def charge_distribution(r):
 
 
 def compute_laplacian(model, r):
-    """计算拉普拉斯算子验证物理定律"""
-    r = r.requires_grad_(True)
-    phi = model(r)
-    
-    grad_phi = torch.autograd.grad(
-        phi, r, 
-        grad_outputs=torch.ones_like(phi), 
-        create_graph=True
-    )[0]
-    
-    laplacian = 0
-    for i in range(3):
-        grad2 = torch.autograd.grad(
-            grad_phi[:, i].unsqueeze(-1), r, 
-            grad_outputs=torch.ones_like(phi), 
-            create_graph=True
-        )[0][:, i]
-        laplacian += grad2
-    
-    return laplacian
+    """计算拉普拉斯算子验证物理定律（前向拉普拉斯传播，无需自动微分）"""
+    return model.forward_laplacian(r)[2]
 
 
 if __name__ == '__main__':
@@ -57,10 +101,19 @@ if __name__ == '__main__':
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     print(f"使用设备: {device}")
     
-    model = PINN(input_dim=3, hidden_dim=256, output_dim=1).to(device)
-    model.load_state_dict(torch.load('docs/assignments/assignment-3-material/pinn.pth', map_location=device))
+    checkpoint = torch.load('docs/assignments/assignment-3-material/pinn.pth', map_location=device)
+    if 'state_dict' in checkpoint:
+        state_dict = checkpoint['state_dict']
+        hard_constraint = checkpoint['hard_constraint']
+    else:
+        # 旧版 pinn.pth 只保存了 state_dict，且没有硬约束
+        state_dict = checkpoint
+        hard_constraint = False
+    model_class = HardConstraintPINN if hard_constraint else PINN
+    model = model_class(input_dim=3, hidden_dim=256, output_dim=1).to(device)
+    model.load_state_dict(state_dict)
     model.eval()
-    print("模型加载成功！")
+    print("模型加载成功！" + ("（硬约束边界）" if hard_constraint else ""))
     
     # ==================== 测试边界条件 ====================
     print("\n【边界条件测试】")
@@ -95,7 +148,8 @@ if __name__ == '__main__':
     n_test = 1000
     test_points = torch.rand(n_test, 3).to(device) * 2 - 1
     
-    laplacian = compute_laplacian(model, test_points)
+    with torch.no_grad():
+        laplacian = compute_laplacian(model, test_points)
     rho = charge_distribution(test_points)
     
     residual = laplacian + rho
@@ -1,9 +1,12 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import matplotlib.pyplot as plt
-from torch.utils.data import DataLoader, TensorDataset
 
 
 # Define the neural network architecture
@@ -33,38 +36,189 @@ class PINN(nn.Module):
         x = self.fc4(x)
         return x
 
+    def forward_laplacian(self, x):
+        """
+        前向拉普拉斯传播：一次前向计算同时得到 φ、∇φ 和 ∇²φ
+        
+        逐层传播值 h、雅可比 J = ∂h/∂x 和拉普拉斯 Δh：
+            线性层 z = hWᵀ + b:  J_z = J Wᵀ,  Δz = Δh Wᵀ
+            tanh 层 h = tanh(z):  J_h = h'·J_z,  Δh = h'·Δz + h''·Σᵢ(J_z)ᵢ²
+        其中 h' = 1 - h²，h'' = -2h·h'。结果与自动微分的结果严格相等，
+        但不需要 create_graph 的多次反向传播。
+        
+        参数:
+            x: 空间坐标 (batch_size, 3)，无需 requires_grad
+        
+        返回:
+            (phi, grad_phi, laplacian_phi)，形状分别为
+            (batch_size, 1)、(batch_size, 3)、(batch_size,)
+        """
+        # 第一层：J_z = W₁ᵀ 对所有点相同，Δz = 0
+        z = self.fc1(x)
+        jac_z = self.fc1.weight.t()                        # (3, hidden)
+        h = torch.tanh(z)
+        d1 = 1 - h**2
+        lap = -2 * h * d1 * (jac_z**2).sum(0)              # (N, hidden)
+        jac = d1.unsqueeze(1) * jac_z                      # (N, 3, hidden)
+        for fc in (self.fc2, self.fc3):
+            z = fc(h)
+            jac_z = jac @ fc.weight.t()
+            lap_z = lap @ fc.weight.t()
+            h = torch.tanh(z)
+            d1 = 1 - h**2
+            lap = d1 * lap_z - 2 * h * d1 * (jac_z**2).sum(1)
+            jac = d1.unsqueeze(1) * jac_z
+        phi = self.fc4(h)
+        grad_phi = (jac @ self.fc4.weight.t()).squeeze(-1)
+        laplacian_phi = (lap @ self.fc4.weight.t()).squeeze(-1)
+        return phi, grad_phi, laplacian_phi
+
+
+class HardConstraintPINN(PINN):
+    """
+    硬约束边界的物理信息神经网络
+    
+    φ(r) = (1-x²)(1-y²)(1-z²)·N(r)，其中 N 为 PINN 的输出，
+    在立方体边界上 φ ≡ 0，因此训练时不再需要边界损失。
+    参数与 PINN 完全相同，可直接加载同一格式的 state_dict。
+    """
+    def forward(self, x):
+        return boundary_factor(x).unsqueeze(-1) * super().forward(x)
+
+    def forward_laplacian(self, x):
+        """
+        前向拉普拉斯传播（硬约束版本）
+        
+        φ = g·N：∇φ = g∇N + N∇g，∇²φ = g∇²N + 2∇g·∇N + N∇²g
+        
+        参数:
+            x: 空间坐标 (batch_size, 3)
+        
+        返回:
+            (phi, grad_phi, laplacian_phi)
+        """
+        n, grad_n, laplacian_n = super().forward_laplacian(x)
+        n = n.squeeze(-1)
+        s = 1 - x**2                                       # (1-x²), (1-y²), (1-z²)
+        g = s.prod(1)
+        # ∂ᵢg = -2xᵢ·Π_{j≠i}(1-xⱼ²)，∇²g = -2·Σᵢ Π_{j≠i}(1-xⱼ²)
+        others = torch.stack([s[:, 1] * s[:, 2], s[:, 0] * s[:, 2], s[:, 0] * s[:, 1]], dim=1)
+        grad_g = -2 * x * others
+        laplacian_g = -2 * others.sum(1)
+        phi = g * n
+        grad_phi = g.unsqueeze(-1) * grad_n + n.unsqueeze(-1) * grad_g
+        laplacian_phi = g * laplacian_n + 2 * (grad_g * grad_n).sum(1) + n * laplacian_g
+        return phi.unsqueeze(-1), grad_phi, laplacian_phi
+
+
+def boundary_factor(r):
+    """
+    硬约束因子 g(r) = (1-x²)(1-y²)(1-z²)，在立方体边界上为 0
+    
+    参数:
+        r: 位置坐标 (batch_size, 3)
+    
+    返回:
+        g 值 (batch_size,)
+    """
+    return (1 - r**2).prod(1)
+
+
+def unit_cube_points(N, dim=3, sampler='random', device='cpu'):
+    """
+    在单位超立方体 [0, 1)^dim 内生成 N 个采样点
+    
+    参数:
+        N: 采样点数量
+        dim: 维度
+        sampler: 'random'（均匀随机）、'sobol'（加扰 Sobol 序列）、
+                 'halton'（随机平移 Halton 序列）或 'lhs'（拉丁超立方）
+        device: 设备 ('cpu' 或 'cuda')
+    
+    返回:
+        torch.Tensor: 形状为 (N, dim) 的张量
+    """
+    if sampler == 'random':
+        return torch.rand((N, dim), device=device)
+    if sampler == 'sobol':
+        seed = int(torch.randint(2**31 - 1, (1,)).item())
+        engine = torch.quasirandom.SobolEngine(dim, scramble=True, seed=seed)
+        return engine.draw(N).to(device)
+    if sampler == 'halton':
+        return halton_sequence(N, dim).to(device)
+    if sampler == 'lhs':
+        # 每一维分成 N 个等宽区间，每个区间恰好一个点，各维区间顺序独立打乱
+        strata = torch.stack([torch.randperm(N) for _ in range(dim)], dim=1)
+        return ((strata + torch.rand(N, dim)) / N).to(device)
+    raise ValueError(f"未知的采样方式: {sampler}")
+
+
+def halton_sequence(N, dim=3):
+    """
+    Halton 低差异序列（以前 dim 个素数为底的根式逆），加随机平移（模 1）
+    
+    参数:
+        N: 采样点数量
+        dim: 维度（不超过 6）
+    
+    返回:
+        torch.Tensor: 形状为 (N, dim) 的张量，取值于 [0, 1)
+    """
+    primes = [2, 3, 5, 7, 11, 13][:dim]
+    index = torch.arange(1, N + 1, dtype=torch.float64)
+    columns = []
+    for base in primes:
+        i = index.clone()
+        x = torch.zeros(N, dtype=torch.float64)
+        f = 1.0
+        while bool((i > 0).any()):
+            f /= base
+            x += f * torch.remainder(i, base)
+            i = torch.floor(i / base)
+        columns.append(x)
+    points = torch.stack(columns, dim=1)
+    shift = torch.rand(dim, dtype=torch.float64)
+    return torch.remainder(points + shift, 1.0).float()
+
 
-def sample_points_in_cube(N, device='cpu'):
+def sample_points_in_cube(N, device='cpu', sampler='random'):
     """
-    在3D立方体域 [-1, 1] × [-1, 1] × [-1, 1] 内随机采样点
+    在3D立方体域 [-1, 1] × [-1, 1] × [-1, 1] 内采样点
     
     参数:
         N: 采样点数量
         device: 设备 ('cpu' 或 'cuda')
+        sampler: 采样方式，见 unit_cube_points
     
     返回:
         torch.Tensor: 形状为 (N, 3) 的张量
     """
-    points = torch.rand((N, 3), device=device) * 2 - 1  # 从 [0,1] 缩放到 [-1,1]
+    points = unit_cube_points(N, 3, sampler, device) * 2 - 1  # 从 [0,1] 缩放到 [-1,1]
     return points
 
 
-def sample_points_in_boundary(N, device='cpu'):
+def sample_points_in_boundary(N, device='cpu', sampler='random'):
     """
     在立方体的6个边界面上采样点
     
     参数:
         N: 每个方向的采样点数（总点数约为 6*N²）
         device: 设备 ('cpu' 或 'cuda')
+        sampler: 'random' 时使用随机坐标的网格；其余取值在每个面上
+                 使用 N² 个二维低差异点，见 unit_cube_points
     
     返回:
         torch.Tensor: 边界点集合
     """
-    x_train = torch.rand(N, device=device) * 2 - 1
-    y_train = torch.rand(N, device=device) * 2 - 1
-    x_bn, y_bn = torch.meshgrid(x_train, y_train, indexing='ij')
-    x_bn = x_bn.flatten()
-    y_bn = y_bn.flatten()
+    if sampler == 'random':
+        x_train = torch.rand(N, device=device) * 2 - 1
+        y_train = torch.rand(N, device=device) * 2 - 1
+        x_bn, y_bn = torch.meshgrid(x_train, y_train, indexing='ij')
+        x_bn = x_bn.flatten()
+        y_bn = y_bn.flatten()
+    else:
+        face = unit_cube_points(N * N, 2, sampler, device) * 2 - 1
+        x_bn, y_bn = face[:, 0], face[:, 1]
     
     # 6个面：z=±1, y=±1, x=±1
     r_bn = [
@@ -79,6 +233,101 @@ def sample_points_in_boundary(N, device='cpu'):
     return r_bn
 
 
+class CollocationPool:
+    """
+    预先生成在设备上的域内采样点池
+    
+    每轮不再重新生成点，而是复用同一个池：
+        'rotate': 对整个池做随机平移（模立方体周期），保持低差异结构，
+                  每轮得到一组新的点
+        'shuffle': 打乱池的顺序后依次取出；取完一遍后重新打乱，并对池做
+                   一次新的随机平移，因此池只够一次 draw 时每轮的点也不同
+    两种方式下 draw 的点数都不能超过池大小。
+    """
+    def __init__(self, size, sampler='sobol', mode='rotate', device='cpu'):
+        self.points = unit_cube_points(size, 3, sampler, device)
+        self.mode = mode
+        self.order = torch.randperm(size, device=device)
+        self.shift = torch.zeros(3, device=device)
+        self.position = 0
+
+    def draw(self, N):
+        """
+        取出 N 个域内点
+        
+        参数:
+            N: 点数，不超过池大小
+        
+        返回:
+            torch.Tensor: 形状为 (N, 3) 的张量，取值于 [-1, 1]
+        """
+        size = len(self.points)
+        if N > size:
+            raise ValueError(f"draw 的点数 {N} 超过点池大小 {size}")
+        if self.mode == 'rotate':
+            shift = torch.rand(3, device=self.points.device)
+            points = torch.remainder(self.points[:N] + shift, 1.0)
+        else:
+            if self.position + N > size:
+                self.order = torch.randperm(size, device=self.points.device)
+                self.shift = torch.rand(3, device=self.points.device)
+                self.position = 0
+            index = self.order[self.position:self.position + N]
+            points = torch.remainder(self.points[index] + self.shift, 1.0)
+            self.position += N
+        return points * 2 - 1
+
+
+class ResidualSampler:
+    """
+    基于残差的自适应采样（RAR）
+    
+    每隔若干轮从候选点池中取出一批候选点，在不建立计算图的前提下计算
+    PDE残差 |∇²φ + ρ|，之后按概率
+        pᵢ = (1 - mix)·|Rᵢ| / Σ|R| + mix / M
+    从候选点中抽取训练点（M 为候选点数，mix 为均匀分布的混合比例，
+    保证残差小的区域仍有点覆盖）。配合重要性权重 wᵢ = 1 / (M·pᵢ)，
+    加权均方残差是候选点上均匀均值的无偏估计，总点数保持不变。
+    """
+    def __init__(self, pool, size, mix=0.5, chunk_size=16384):
+        self.pool = pool
+        self.size = size
+        self.mix = mix
+        self.chunk_size = chunk_size
+        self.candidates = None
+        self.probs = None
+
+    def score(self, model):
+        """
+        取出新的候选点并用当前模型计算残差（无计算图）
+        
+        参数:
+            model: PINN 模型
+        """
+        candidates = self.pool.draw(self.size)
+        with torch.no_grad():
+            residual = torch.cat([
+                poisson_forward(model, chunk)[1].abs()
+                for chunk in candidates.split(self.chunk_size)
+            ])
+        self.candidates = candidates
+        self.probs = (1 - self.mix) * residual / residual.sum() + self.mix / len(candidates)
+
+    def draw(self, N):
+        """
+        按残差大小抽取 N 个训练点
+        
+        参数:
+            N: 点数
+        
+        返回:
+            (points, weights): 训练点 (N, 3) 和重要性权重 (N,)
+        """
+        index = torch.multinomial(self.probs, N, replacement=True)
+        weights = 1 / (len(self.probs) * self.probs[index])
+        return self.candidates[index], weights
+
+
 def charge_distribution(r):
     """
     定义电荷分布 ρ(x,y,z)
@@ -92,11 +341,60 @@ def charge_distribution(r):
     return 100 * r[:, 0] * r[:, 1] * r[:, 2]**2
 
 
+def poisson_forward(model, r):
+    """
+    计算泊松方程残差: ∇²φ + ρ = 0
+    
+    使用前向拉普拉斯传播（PINN.forward_laplacian）在一次前向计算中得到 ∇²φ，
+    结果与 poisson() 相同，但计算图只有一层，训练时只需一次一阶反向传播
+    
+    参数:
+        model: PINN 模型
+        r: 空间坐标（无需 requires_grad）
+    
+    返回:
+        (phi, equation): 预测的电势和方程残差
+    """
+    phi, _, laplacian_phi = model.forward_laplacian(r)
+    equation = laplacian_phi + charge_distribution(r)
+    return phi, equation
+
+
+def poisson_stencil(model, r, h=0.02):
+    """
+    计算泊松方程残差: ∇²φ + ρ = 0
+    
+    使用7点有限差分近似拉普拉斯算子：
+        ∇²φ ≈ Σᵢ [φ(r + h·eᵢ) + φ(r - h·eᵢ) - 2φ(r)] / h²
+    中心点与6个邻点拼接成一个批次，一次前向传播完成，训练时只需一阶反向传播。
+    截断误差为 O(h²)，适合训练前期快速下降损失。
+    
+    参数:
+        model: PINN 模型
+        r: 空间坐标 (batch_size, 3)
+        h: 差分步长
+    
+    返回:
+        (phi, equation): 中心点的电势和方程残差
+    """
+    offsets = torch.cat([
+        torch.zeros(1, 3, device=r.device, dtype=r.dtype),
+        h * torch.eye(3, device=r.device, dtype=r.dtype),
+        -h * torch.eye(3, device=r.device, dtype=r.dtype)
+    ])                                              # (7, 3)
+    stencil = (r.unsqueeze(0) + offsets.unsqueeze(1)).reshape(-1, 3)
+    phi_all = model(stencil).reshape(7, -1)
+    phi = phi_all[0]
+    laplacian_phi = (phi_all[1:].sum(0) - 6 * phi) / h**2
+    equation = laplacian_phi + charge_distribution(r)
+    return phi.unsqueeze(-1), equation
+
+
 def poisson(phi, r):
     """
     计算泊松方程残差: ∇²φ + ρ = 0
     
-    使用自动微分计算拉普拉斯算子
+    使用自动微分计算拉普拉斯算子（参考实现，用于校验 poisson_forward）
     
     参数:
         phi: 神经网络预测的电势
@@ -130,6 +428,214 @@ def poisson(phi, r):
     return equation
 
 
+
+def residual(model, r, laplacian='forward', h=0.02):
+    """
+    按指定方式计算泊松方程残差
+    
+    参数:
+        model: PINN 模型
+        r: 空间坐标 (batch_size, 3)
+        laplacian: 'forward'（poisson_forward）、'stencil'（poisson_stencil）
+                   或 'autograd'（poisson）
+        h: 差分步长（仅 'stencil'）
+    
+    返回:
+        (phi, equation): 预测的电势和方程残差
+    """
+    if laplacian == 'stencil':
+        return poisson_stencil(model, r, h=h)
+    if laplacian == 'forward':
+        return poisson_forward(model, r)
+    r = r.detach().requires_grad_(True)
+    phi = model(r)
+    return phi, poisson(phi, r)
+
+
+def pde_loss(model, r, w, n, laplacian='forward', h=0.02):
+    """
+    一个微批上的加权PDE损失 Σ w·R² / n
+    
+    参数:
+        model: PINN 模型
+        r: 空间坐标 (batch_size, 3)
+        w: 每个点的权重 (batch_size,)
+        n: 整批的点数（归一化用）
+        laplacian: 残差计算方式，见 residual
+        h: 差分步长（仅 'stencil'）
+    
+    返回:
+        标量损失
+    """
+    _, equation = residual(model, r, laplacian, h)
+    return torch.sum(w * equation**2) / n
+
+
+def boundary_loss(model, r_bn):
+    """边界损失 mean(φ²)，边界条件 φ = 0"""
+    return torch.mean(model(r_bn)**2)
+
+
+def compile_loss(fn, *example, rtol=1e-4):
+    """
+    用 torch.compile 把模型、残差和损失编译成一个函数，不可用时退回 eager
+    
+    编译后在 example 上与 eager 结果比较，相对偏差超过 rtol 同样退回 eager。
+    二阶自动微分（laplacian='autograd'）不支持编译，应直接使用 eager。
+    
+    参数:
+        fn: 待编译的损失函数，如 pde_loss 或 boundary_loss
+        example: 用于编译和校验的示例参数
+        rtol: 允许的相对偏差
+    
+    返回:
+        编译后的函数或原函数
+    """
+    if not hasattr(torch, 'compile'):
+        print("torch.compile 不可用，使用 eager 模式")
+        return fn
+    try:
+        compiled = torch.compile(fn)
+        loss_compiled = compiled(*example).detach()
+    except Exception as e:
+        print(f"编译失败，使用 eager 模式: {type(e).__name__}: {e}")
+        return fn
+    loss_eager = fn(*example).detach()
+    error = (torch.abs(loss_compiled - loss_eager) / torch.abs(loss_eager)).item()
+    print(f"编译与 eager 损失相对偏差: {error:.3e}")
+    if error > rtol:
+        print("偏差过大，使用 eager 模式")
+        return fn
+    return compiled
+
+
+def steps_per_second(model, fn, *args, steps=5):
+    """
+    测量训练步（前向 + 反向）的速度
+    
+    参数:
+        model: PINN 模型
+        fn: 损失函数
+        args: 损失函数参数
+        steps: 计时的步数（另有一步预热）
+    
+    返回:
+        float: 每秒步数
+    """
+    for i in range(steps + 1):
+        if i == 1:
+            start = time.perf_counter()
+        model.zero_grad()
+        fn(model, *args).backward()
+    if next(model.parameters()).is_cuda:
+        torch.cuda.synchronize()
+    model.zero_grad()
+    return steps / (time.perf_counter() - start)
+
+
+def micro_batch_size(model, memory_budget, laplacian='forward', h=0.02, probe=1024):
+    """
+    根据内存预算自动选择域内点的微批大小
+    
+    在 probe 个点上计算一次残差，统计计算图中为反向传播保存的张量
+    （不含模型参数，相同存储只计一次），得到每个点占用的字节数，
+    再留出一倍余量给反向传播时的临时张量。
+    
+    参数:
+        model: PINN 模型
+        memory_budget: 计算图内存预算（字节）
+        laplacian: 残差计算方式，见 residual
+        h: 差分步长（仅 'stencil'）
+        probe: 探测用的点数
+    
+    返回:
+        int: 微批大小
+    """
+    weight = next(model.parameters())
+    params = {p.data_ptr() for p in model.parameters()}
+    storages = {}
+
+    def pack(t):
+        ptr = t.untyped_storage().data_ptr()
+        if ptr not in params:
+            storages[ptr] = t.untyped_storage().nbytes()
+        return t
+
+    r = sample_points_in_cube(probe, device=weight.device).to(weight.dtype)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        _, equation = residual(model, r, laplacian, h)
+        torch.mean(equation**2)
+    per_point = 2 * sum(storages.values()) / probe
+    return max(1, int(memory_budget // per_point))
+
+
+
+class LossWriter:
+    """
+    后台线程写入损失记录
+    
+    训练循环把每 k 步的损失留在设备上，flush 时把整块数据交给后台线程，
+    由后台线程拷贝到主机并追加写入 JSONL 文件（每行一轮），
+    close 时再把全部记录保存为 .npy。主循环因此不需要每步同步设备。
+    """
+    columns = ('loss', 'pde_loss', 'bn_loss', 'beta')
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        open(path, 'w').close()
+
+    def write(self, first_epoch, block):
+        """
+        异步写入一块损失记录
+        
+        参数:
+            first_epoch: 这一块第一行对应的轮数（从 1 开始）
+            block: 设备上的张量 (k, len(columns))，调用后不可再修改
+        """
+        self.futures.append(self.executor.submit(self.append, first_epoch, block))
+
+    def append(self, first_epoch, block):
+        rows = block.cpu().numpy()
+        with open(self.path, 'a') as f:
+            for i, row in enumerate(rows):
+                record = {'epoch': first_epoch + i}
+                record.update(zip(self.columns, map(float, row)))
+                f.write(json.dumps(record) + '\n')
+        self.rows.append(rows)
+        return rows
+
+    def close(self):
+        """
+        等待所有写入完成，并把全部记录保存为同名 .npy 文件
+        
+        后台写入中出现的异常（如 I/O 错误）在这里重新抛出
+        """
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        rows = np.concatenate(self.rows) if self.rows else np.zeros((0, len(self.columns)))
+        np.save(self.path.rsplit('.', 1)[0] + '.npy', rows)
+
+
+def load_losses(path):
+    """
+    读取 LossWriter 写出的 JSONL 损失记录
+    
+    参数:
+        path: JSONL 文件路径
+    
+    返回:
+        dict: 列名 -> np.ndarray，另含 'epoch'
+    """
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    return {key: np.array([r[key] for r in records])
+            for key in ('epoch',) + LossWriter.columns}
+
+
 if __name__ == '__main__':
     # ==================== 超参数设置 ====================
     input_dim = 3           # 输入维度 (x, y, z)
@@ -139,78 +645,273 @@ if __name__ == '__main__':
     num_epochs = 20000      # 训练轮数
     learning_rate = 0.001   # 学习率
     beta = 1.0              # PDE损失权重（相对于边界损失）
+    hard_constraint = False # 使用硬约束 φ = (1-x²)(1-y²)(1-z²)·N(r)，无需边界损失
+    adaptive_beta = False   # 按梯度范数之比自动调整 beta（学习率退火）
+    beta_every = 10         # 每隔多少步更新一次 beta
+    beta_alpha = 0.9        # beta 的滑动平均系数
     
     nt = 32                 # 域内采样倍数
     n = 21                  # 边界采样密度
+    sampler = 'sobol'       # 采样方式: 'random'、'sobol'、'halton' 或 'lhs'
+    pool_mode = 'rotate'    # 域内点池的复用方式: 'rotate'（随机平移）或 'shuffle'（打乱）
+    pool_factor = 4         # 'shuffle' 方式下点池大小相对域内点数的倍数
+    adaptive = False        # 使用基于残差的自适应采样（RAR）
+    rar_candidates = 4      # 候选点数相对域内点数的倍数
+    rar_every = 100         # 每隔多少轮重新计算候选点残差
+    rar_mix = 0.5           # 采样概率中均匀分布的比例
+    
+    laplacian = 'forward'   # 拉普拉斯算子计算方式: 'stencil'（有限差分）、'forward'（前向传播）或 'autograd'
+    exact_laplacian = 'forward'  # 差分阶段结束后切换到的精确方式
+    stencil_h = 0.02        # 差分步长
+    stencil_epochs = 5000   # 差分阶段最多持续的轮数
+    plateau_patience = 500  # PDE损失连续多少轮无改善即提前切换
+    plateau_tol = 0.01      # 视为改善的相对下降幅度
+    
+    memory_budget = 8 * 2**30  # 计算图内存预算（字节），据此自动选择微批大小
+    compile_step = True     # 用 torch.compile 编译模型、残差和损失（autograd 方式除外）
+    benchmark_compile = False # 训练前比较编译与 eager 的每秒步数
+    
+    log_every = 100         # 损失在设备上累积的步数，每隔这么多步写出并打印一次
+    
+    lbfgs = True            # Adam 阶段结束后用全批 L-BFGS 微调
+    adam_patience = 10      # Adam 损失连续多少个 log_every 区块无改善即提前结束
+    adam_tol = 0.01         # 视为改善的相对下降幅度（按区块平均损失）
+    lbfgs_steps = 50        # L-BFGS 外层步数上限
+    lbfgs_iter = 20         # 每个外层步内最多迭代次数（含强 Wolfe 线搜索）
+    lbfgs_tol = 1e-6        # 相邻外层步损失的相对变化小于该值即视为收敛
+    loss_log = 'docs/assignments/assignment-3-material/losses.jsonl'
     
     # 自动检测设备
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     print(f"使用设备: {device}")
     
     # ==================== 初始化模型 ====================
-    model = PINN(input_dim, hidden_dim, output_dim).to(device)
+    model_class = HardConstraintPINN if hard_constraint else PINN
+    model = model_class(input_dim, hidden_dim, output_dim).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
     
     print(f"模型参数总数: {sum(p.numel() for p in model.parameters())}")
     
-    # ==================== 边界点采样 ====================
-    r_bn = sample_points_in_boundary(N=n, device=device)
-    r_bn = r_bn.requires_grad_(True)
-    print(f"边界点数量: {r_bn.shape[0]}")
+    # ==================== 边界点采样（硬约束时不需要） ====================
+    if not hard_constraint:
+        r_bn = sample_points_in_boundary(N=n, device=device, sampler=sampler)
+        print(f"边界点数量: {r_bn.shape[0]}")
+    
+    # 校验前向拉普拉斯传播与自动微分结果一致
+    r_check = sample_points_in_cube(N=256, device=device).requires_grad_(True)
+    _, equation_forward = poisson_forward(model, r_check)
+    equation_autograd = poisson(model(r_check), r_check)
+    print(f"前向拉普拉斯与自动微分最大偏差: "
+          f"{torch.max(torch.abs(equation_forward - equation_autograd)).item():.3e}")
+    
+    # ==================== 域内点池 ====================
+    n_in = nt * 6 * n * n   # 边界点数量的 nt 倍
+    pool_size = n_in if pool_mode == 'rotate' else pool_factor * n_in
+    pool = CollocationPool(pool_size, sampler=sampler, mode=pool_mode, device=device)
+    if adaptive:
+        rar = ResidualSampler(
+            CollocationPool(rar_candidates * n_in, sampler=sampler, device=device),
+            rar_candidates * n_in, mix=rar_mix
+        )
+    
+    micro_batch = micro_batch_size(model, memory_budget, laplacian, stencil_h)
+    print(f"域内点数量: {n_in}，微批大小: {min(micro_batch, n_in)}")
+    
+    # ==================== 编译训练步 ====================
+    pde_step = pde_loss
+    bn_step = boundary_loss
+    if compile_step and 'autograd' not in (laplacian, exact_laplacian):
+        r_mb = pool.draw(min(micro_batch, n_in))
+        w_mb = torch.ones(len(r_mb), device=device)
+        pde_step = compile_loss(pde_loss, model, r_mb, w_mb, n_in, laplacian, stencil_h)
+        if not hard_constraint:
+            bn_step = compile_loss(boundary_loss, model, r_bn)
+        if benchmark_compile and pde_step is not pde_loss:
+            args = (r_mb, w_mb, n_in, laplacian, stencil_h)
+            print(f"每秒步数: eager {steps_per_second(model, pde_loss, *args):.2f}, "
+                  f"编译 {steps_per_second(model, pde_step, *args):.2f}")
     
     # ==================== 训练循环 ====================
-    losses = []
-    pde_losses = []
-    bn_losses = []
+    pde_weight = torch.tensor(1.0 if hard_constraint else beta, device=device)
+    params = list(model.parameters())
+    loss_buffer = torch.zeros((log_every, len(LossWriter.columns)), device=device)
+    writer = LossWriter(loss_log)
+    
+    best_pde = float('inf')
+    plateau = 0
+    best_block = float('inf')
+    adam_plateau = 0
     
     print("\n开始训练...")
     for epoch in range(num_epochs):
         model.train()
         optimizer.zero_grad()
         
-        # 每轮重新采样域内点（增强随机性）
-        r_in = sample_points_in_cube(N=nt*len(r_bn), device=device)
-        r_in = r_in.requires_grad_(True)
+        # 每轮从点池中取出域内点（随机平移或打乱，增强随机性）
+        if adaptive:
+            if epoch % rar_every == 0:
+                rar.score(model)
+            r_in, w_in = rar.draw(n_in)
+        else:
+            r_in = pool.draw(n_in)
+            w_in = torch.ones(n_in, device=device)
+        
+        # PDE残差：按微批计算并累积梯度，等价于整批的一步
+        loss_pde = torch.zeros((), device=device)
+        for r_mb, w_mb in zip(r_in.split(micro_batch), w_in.split(micro_batch)):
+            loss_mb = pde_step(model, r_mb, w_mb, n_in, laplacian, stencil_h)
+            (pde_weight * loss_mb).backward()
+            loss_pde += loss_mb.detach()
         
-        # 前向传播：预测电势
-        phi = model(r_in)
+        # 边界条件：φ = 0（硬约束时自动满足）
+        update_beta = adaptive_beta and not hard_constraint and epoch % beta_every == 0
+        if hard_constraint:
+            loss_bn = torch.zeros((), device=device)
+        else:
+            loss_bn = bn_step(model, r_bn)
+            if update_beta:
+                # 此时 .grad 中只有 PDE 项的梯度；边界项梯度单独求出后再累加，
+                # 反向传播次数与直接 loss_bn.backward() 相同
+                grads_bn = torch.autograd.grad(loss_bn, params, allow_unused=True)
+                norm_pde = torch.sqrt(sum(torch.sum(p.grad**2) for p in params if p.grad is not None))
+                norm_bn = torch.sqrt(sum(torch.sum(g**2) for g in grads_bn if g is not None))
+                for p, g in zip(params, grads_bn):
+                    if g is not None:
+                        p.grad = g if p.grad is None else p.grad + g
+            else:
+                loss_bn.backward()
+        loss = loss_bn.detach() + pde_weight * loss_pde
         
-        # 计算PDE残差
-        equation = poisson(phi, r_in)
-        loss_pde = torch.mean(equation**2)
+        optimizer.step()
         
-        # 边界条件：φ = 0
-        phi_bn = model(r_bn)
-        loss_bn = torch.mean(phi_bn**2)
+        # 记录损失（留在设备上，不同步）
+        step = epoch % log_every
+        loss_buffer[step, 0] = loss.detach()
+        loss_buffer[step, 1] = loss_pde
+        loss_buffer[step, 2] = loss_bn.detach()
+        loss_buffer[step, 3] = pde_weight  # 本步实际使用的 beta
         
-        # 总损失
-        loss = loss_bn + beta * loss_pde
+        # 学习率退火：使两项梯度范数相当，β̂ = ‖∇L_bn‖ / ‖∇L_pde‖，
+        # 对 beta 做滑动平均（全程留在设备上），从下一步起生效
+        if update_beta:
+            beta_hat = norm_bn / (norm_pde / pde_weight + 1e-12)
+            pde_weight = beta_alpha * pde_weight + (1 - beta_alpha) * beta_hat
         
-        # 反向传播
-        loss.backward()
-        optimizer.step()
+        # 每 log_every 步（或最后一轮）整块交给后台线程写出
+        if step == log_every - 1 or epoch == num_epochs - 1:
+            block = loss_buffer[:step + 1].clone()
+            writer.write(epoch - step + 1, block)
+            
+            # 打印进度（此处同步一次）
+            if step == log_every - 1:
+                rows = block.cpu()
+                print(f"Epoch [{epoch+1}/{num_epochs}], "
+                      f"Total Loss: {rows[-1, 0].item():.6f}, "
+                      f"PDE Loss: {rows[-1, 1].item():.6f}, "
+                      f"BC Loss: {rows[-1, 2].item():.6f}, "
+                      f"Beta: {rows[-1, 3].item():.4g}")
+                
+                # 差分阶段：按计划轮数或损失停滞时切换到精确残差
+                if laplacian == 'stencil':
+                    for pde in rows[:, 1].tolist():
+                        if pde < best_pde * (1 - plateau_tol):
+                            best_pde = pde
+                            plateau = 0
+                        else:
+                            plateau += 1
+                
+                # Adam 停滞：区块平均损失连续 adam_patience 个区块无改善；
+                # 用 PDE 损失与边界损失之和，不受 beta 变化的影响
+                elif lbfgs:
+                    block_loss = (rows[:, 1] + rows[:, 2]).mean().item()
+                    if block_loss < best_block * (1 - adam_tol):
+                        best_block = block_loss
+                        adam_plateau = 0
+                    else:
+                        adam_plateau += 1
+                    if adam_plateau >= adam_patience:
+                        print(f"Epoch [{epoch+1}/{num_epochs}], Adam 损失停滞，结束 Adam 阶段")
+                        break
         
-        # 记录损失
-        losses.append(loss.item())
-        pde_losses.append(loss_pde.item())
-        bn_losses.append(loss_bn.item())
+        if laplacian == 'stencil':
+            if epoch + 1 >= stencil_epochs or plateau >= plateau_patience:
+                laplacian = exact_laplacian
+                micro_batch = micro_batch_size(model, memory_budget, laplacian)
+                print(f"Epoch [{epoch+1}/{num_epochs}], 切换到精确残差: {laplacian}，"
+                      f"微批大小: {min(micro_batch, n_in)}")
+                # 新的残差方式需要重新编译，并重新与 eager 比较
+                if pde_step is not pde_loss:
+                    r_mb = r_in[:micro_batch]
+                    pde_step = compile_loss(pde_loss, model, r_mb, torch.ones(len(r_mb), device=device),
+                                            n_in, laplacian, stencil_h)
+    
+    # ==================== L-BFGS 微调 ====================
+    if lbfgs:
+        # 固定的域内点集，保证线搜索中的目标函数确定
+        r_in = pool.draw(n_in)
+        w_in = torch.ones(n_in, device=device)
+        if laplacian == 'stencil':
+            laplacian = exact_laplacian
+            micro_batch = micro_batch_size(model, memory_budget, laplacian)
+            if pde_step is not pde_loss:
+                r_mb = r_in[:micro_batch]
+                pde_step = compile_loss(pde_loss, model, r_mb, w_in[:micro_batch],
+                                        n_in, laplacian, stencil_h)
+        optimizer = torch.optim.LBFGS(
+            model.parameters(), lr=1.0, max_iter=lbfgs_iter,
+            history_size=50, line_search_fn='strong_wolfe'
+        )
         
-        # 打印进度
-        if (epoch + 1) % 100 == 0:
-            print(f"Epoch [{epoch+1}/{num_epochs}], "
-                  f"Total Loss: {loss.item():.6f}, "
-                  f"PDE Loss: {loss_pde.item():.6f}, "
-                  f"BC Loss: {loss_bn.item():.6f}")
+        def closure():
+            """全批损失及其梯度（微批累积），供 L-BFGS 及其线搜索反复调用"""
+            optimizer.zero_grad()
+            loss_pde = torch.zeros((), device=device)
+            for r_mb, w_mb in zip(r_in.split(micro_batch), w_in.split(micro_batch)):
+                loss_mb = pde_step(model, r_mb, w_mb, n_in, laplacian, stencil_h)
+                (pde_weight * loss_mb).backward()
+                loss_pde += loss_mb.detach()
+            if hard_constraint:
+                loss_bn = torch.zeros((), device=device)
+            else:
+                loss_bn = bn_step(model, r_bn)
+                loss_bn.backward()
+            loss = loss_bn.detach() + pde_weight * loss_pde
+            loss_buffer[0] = torch.stack([loss, loss_pde, loss_bn.detach(), pde_weight])
+            return loss
+        
+        print(f"\n开始 L-BFGS 微调（{n_in} 个固定域内点）...")
+        start = time.perf_counter()
+        # 收敛判据用 PDE 损失与边界损失之和，与 beta 无关
+        closure()
+        last = (loss_buffer[0, 1] + loss_buffer[0, 2]).item()
+        for step in range(lbfgs_steps):
+            optimizer.step(closure)
+            loss = closure().item()  # step() 返回的是步前损失，这里取步后损失
+            unweighted = (loss_buffer[0, 1] + loss_buffer[0, 2]).item()
+            epoch += 1
+            writer.write(epoch + 1, loss_buffer[:1].clone())
+            print(f"L-BFGS [{step+1}/{lbfgs_steps}], Total Loss: {loss:.6f}")
+            if not np.isfinite(unweighted) or abs(last - unweighted) <= lbfgs_tol * abs(last):
+                break
+            last = unweighted
+        print(f"L-BFGS 结束，用时 {time.perf_counter() - start:.1f} 秒")
+    
+    writer.close()
+    print(f"损失记录已保存到 {loss_log.rsplit('/', 1)[-1]}")
     
     # ==================== 保存模型和结果 ====================
-    torch.save(model.state_dict(), 'docs/assignments/assignment-3-material/pinn.pth')
+    # 同时保存是否使用硬约束，test.py 据此构建对应的模型
+    torch.save({'state_dict': model.state_dict(), 'hard_constraint': hard_constraint},
+               'docs/assignments/assignment-3-material/pinn.pth')
     print("\n模型已保存到 pinn.pth")
     
-    # 保存训练损失曲线
+    # 保存训练损失曲线（从损失记录文件读取）
+    history = load_losses(loss_log)
     plt.figure(figsize=(10, 6))
-    plt.semilogy(losses, label='Total Loss', alpha=0.7)
-    plt.semilogy(pde_losses, label='PDE Loss', alpha=0.7)
-    plt.semilogy(bn_losses, label='Boundary Loss', alpha=0.7)
+    plt.semilogy(history['epoch'], history['loss'], label='Total Loss', alpha=0.7)
+    plt.semilogy(history['epoch'], history['pde_loss'], label='PDE Loss', alpha=0.7)
+    if not hard_constraint:
+        plt.semilogy(history['epoch'], history['bn_loss'], label='Boundary Loss', alpha=0.7)
     plt.xlabel('Epoch')
     plt.ylabel('Loss (log scale)')
     plt.title('Training Loss Curves')
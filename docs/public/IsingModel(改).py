@@ -7,10 +7,22 @@ It takes a while to generate the datasets.
 #### Libraries
 # Standard library
 import os
+import io
+import copy
 import json
+import itertools
+import contextlib
 import random
+import struct
 import sys
 import math
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
 
 # Third-party libraries
 import numpy as np
@@ -29,36 +41,220 @@ class QuadraticCost(object):
         return 0.5*np.linalg.norm(a-y)**2
 
     @staticmethod
-    def delta(z, a, y):
-        """Return the error delta from the output layer."""
-        return (a-y) * sigmoid_prime(z)
+    def delta(z, a, y, out=None):
+        """Return the error delta from the output layer.  The sigmoid
+        derivative is taken from the activation ``a`` rather than
+        recomputed from ``z``.  If ``out`` is given, the delta is
+        written into it."""
+        if out is None:
+            return (a-y) * a*(1-a)
+        np.subtract(1, a, out=out)
+        out *= a
+        out *= a-y
+        return out
 
 
 class CrossEntropyCost(object):
     @staticmethod
     def fn(a, y):
         """Return the cost associated with an output ``a`` and desired output
-        ``y``.  Note that np.nan_to_num is used to ensure numerical
-        stability.  In particular, if both ``a`` and ``y`` have a 1.0
-        in the same slot, then the expression (1-y)*np.log(1-a)
-        returns nan.  The np.nan_to_num ensures that that is converted
-        to the correct value (0.0).
+        ``y``.  An output that has rounded to exactly 0.0 or 1.0,
+        which in float32 happens for the upper tail from z of about 17,
+        would make a log infinite; ``a`` and ``1-a`` are therefore
+        bounded below by the smallest positive values they can take
+        in the dtype of ``a`` (the smallest normal number and half the
+        machine epsilon), so the cost stays finite.  np.nan_to_num
+        still guards against nan inputs.
         """
-        return np.sum(np.nan_to_num(-y*np.log(a)-(1-y)*np.log(1-a)))
+        info = np.finfo(a.dtype)
+        return np.sum(np.nan_to_num(-y*np.log(np.maximum(a, info.tiny))
+                                    -(1-y)*np.log(np.maximum(1-a, info.eps/2))))
 
     @staticmethod
-    def delta(z, a, y):
+    def delta(z, a, y, out=None):
         """Return the error delta from the output layer.  Note that the
         parameter ``z`` is not used by the method.  It is included in
         the method's parameters in order to make the interface
-        consistent with the delta method for other cost classes.
+        consistent with the delta method for other cost classes.  If
+        ``out`` is given, the delta is written into it.
         """
-        return (a-y)
+        if out is None:
+            return (a-y)
+        return np.subtract(a, y, out=out)
+
+
+#### Optimizers and learning-rate schedules
+class Optimizer(object):
+    """Shared bookkeeping of the optimizers passed to ``Network.SGD``.
+    An optimizer provides ``update(params, grads, decays, eta)``, which
+    updates the arrays ``params`` in place, given the gradients
+    ``grads`` of the mean cost over the mini-batch (used as scratch and
+    overwritten), the L2 weight decay factor of each parameter and the
+    learning rate ``eta``.  It keeps per-parameter state, as one list
+    of arrays per name in ``slots`` (indexed like ``net.weights +
+    net.biases``), and the number ``t`` of steps taken.  ``state`` and
+    ``load_state`` convert it to and from a flat dict of arrays for
+    checkpoints, and ``config`` returns the keyword arguments to
+    recreate the optimizer.
+    """
+    slots = ()
+
+    def __init__(self):
+        self.t = 0
+        self.scratch = None
+        for slot in self.slots:
+            setattr(self, slot, None)
+
+    def prepare(self, params):
+        """Allocate the state (zeros) and the scratch buffers on the
+        first step."""
+        if self.scratch is None:
+            self.scratch = [np.empty_like(p) for p in params]
+        for slot in self.slots:
+            if getattr(self, slot) is None:
+                setattr(self, slot, [np.zeros_like(p) for p in params])
+
+    def config(self):
+        return {}
+
+    def state(self):
+        state = {"t": np.array(self.t)}
+        for slot in self.slots:
+            for i, a in enumerate(getattr(self, slot) or []):
+                state["%s%d" % (slot, i)] = a
+        return state
+
+    def load_state(self, state):
+        self.t = int(state["t"])
+        for slot in self.slots:
+            arrays = []
+            while "%s%d" % (slot, len(arrays)) in state:
+                arrays.append(np.array(state["%s%d" % (slot, len(arrays))]))
+            setattr(self, slot, arrays or None)
+
+
+class Momentum(Optimizer):
+    """Gradient descent with momentum ``mu``: the step is the decaying
+    sum of the past gradients.  If ``nesterov`` is set, the gradient is
+    in effect taken at the look-ahead point (Nesterov's accelerated
+    gradient, in the form of Sutskever et al.)."""
+    slots = ("velocities",)
+
+    def __init__(self, mu=0.9, nesterov=False):
+        Optimizer.__init__(self)
+        self.mu = mu
+        self.nesterov = nesterov
+
+    def config(self):
+        return {"mu": self.mu, "nesterov": self.nesterov}
+
+    def update(self, params, grads, decays, eta):
+        self.prepare(params)
+        self.t += 1
+        mu = self.mu
+        for p, g, decay, v, s in zip(params, grads, decays,
+                                     self.velocities, self.scratch):
+            if decay:
+                np.multiply(p, decay, out=s)
+                g += s
+            if self.nesterov:
+                # p += -mu*v_old + (1+mu)*v_new
+                np.multiply(v, mu, out=s)
+                p -= s
+            v *= mu
+            g *= eta
+            v -= g
+            if self.nesterov:
+                np.multiply(v, 1+mu, out=s)
+                p += s
+            else:
+                p += v
+
+
+class Adam(Optimizer):
+    """The Adam optimizer of Kingma and Ba, with the usual defaults for
+    ``beta1``, ``beta2`` and ``eps``.  The L2 regularization enters
+    through the gradient, as for plain gradient descent."""
+    slots = ("moments", "variances")
+
+    def __init__(self, beta1=0.9, beta2=0.999, eps=1e-8):
+        Optimizer.__init__(self)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+
+    def config(self):
+        return {"beta1": self.beta1, "beta2": self.beta2, "eps": self.eps}
+
+    def update(self, params, grads, decays, eta):
+        self.prepare(params)
+        self.t += 1
+        beta1, beta2 = self.beta1, self.beta2
+        # fold the bias corrections into the step size
+        correction = np.sqrt(1-beta2**self.t)
+        step = eta*correction/(1-beta1**self.t)
+        for p, g, decay, m, v, s in zip(params, grads, decays, self.moments,
+                                        self.variances, self.scratch):
+            if decay:
+                np.multiply(p, decay, out=s)
+                g += s
+            m *= beta1
+            np.multiply(g, 1-beta1, out=s)
+            m += s
+            v *= beta2
+            np.multiply(g, g, out=s)
+            s *= 1-beta2
+            v += s
+            np.sqrt(v, out=s)
+            s += self.eps*correction
+            np.divide(m, s, out=s)
+            s *= step
+            p -= s
+
+
+class StepDecay(object):
+    """Learning rate ``eta`` multiplied by ``drop`` every ``every``
+    epochs.  Schedules are called with the (fractional) epoch ``t``."""
+    def __init__(self, eta, drop=0.5, every=10):
+        self.eta = eta
+        self.drop = drop
+        self.every = every
+
+    def __call__(self, t):
+        return self.eta*self.drop**math.floor(t/self.every)
+
+
+class CosineDecay(object):
+    """Learning rate annealed from ``eta`` to ``eta_min`` along half a
+    cosine over ``epochs`` epochs, and constant afterwards."""
+    def __init__(self, eta, epochs, eta_min=0.0):
+        self.eta = eta
+        self.epochs = epochs
+        self.eta_min = eta_min
+
+    def __call__(self, t):
+        t = min(t, self.epochs)
+        return self.eta_min+0.5*(self.eta-self.eta_min)*(
+            1+math.cos(math.pi*t/self.epochs))
+
+
+class Warmup(object):
+    """Linear warm-up of the learning rate ``eta`` (a number or another
+    schedule) over the first ``epochs`` epochs, starting from the
+    fraction ``start`` of it."""
+    def __init__(self, eta, epochs=1.0, start=0.1):
+        self.eta = eta
+        self.epochs = epochs
+        self.start = start
+
+    def __call__(self, t):
+        eta = self.eta(t) if callable(self.eta) else self.eta
+        return eta*(self.start+(1-self.start)*min(1.0, t/self.epochs))
 
 
 #### Main Network class
 class Network(object):
-    def __init__(self, sizes, cost=CrossEntropyCost):
+    def __init__(self, sizes, cost=CrossEntropyCost, dtype=np.float32):
         """The list ``sizes`` contains the number of neurons in the respective
         layers of the network.  For example, if the list was [2, 3, 1]
         then it would be a three-layer network, with the first layer
@@ -66,12 +262,19 @@ class Network(object):
         third layer 1 neuron.  The biases and weights for the network
         are initialized randomly, using
         ``self.default_weight_initializer`` (see docstring for that
-        method).
+        method).  ``dtype`` is the floating point precision of the
+        weights and biases; the data are cast to it for training and
+        evaluation, and it is stored in checkpoints.
         """
         self.num_layers = len(sizes)
         self.sizes = sizes
+        self.dtype = np.dtype(dtype)
         self.default_weight_initializer()
         self.cost=cost
+        self.workspaces = {}
+        self.optimizer = None
+        self.epoch = 0
+        self.profiler = None
 
     def default_weight_initializer(self):
         """Initialize each weight using a Gaussian distribution with mean 0
@@ -84,8 +287,9 @@ class Network(object):
         biases are only ever used in computing the outputs from later
         layers.
         """
-        self.biases = [np.random.randn(y, 1) for y in self.sizes[1:]]
-        self.weights = [np.random.randn(y, x)/np.sqrt(x)
+        self.biases = [np.random.randn(y, 1).astype(self.dtype)
+                       for y in self.sizes[1:]]
+        self.weights = [(np.random.randn(y, x)/np.sqrt(x)).astype(self.dtype)
                         for x, y in zip(self.sizes[:-1], self.sizes[1:])]
 
     def large_weight_initializer(self):
@@ -101,26 +305,73 @@ class Network(object):
         will usually be better to use the default weight initializer
         instead.
         """
-        self.biases = [np.random.randn(y, 1) for y in self.sizes[1:]]
-        self.weights = [np.random.randn(y, x)
+        self.biases = [np.random.randn(y, 1).astype(self.dtype)
+                       for y in self.sizes[1:]]
+        self.weights = [np.random.randn(y, x).astype(self.dtype)
                         for x, y in zip(self.sizes[:-1], self.sizes[1:])]
 
     def feedforward(self, a):
         """Return the output of the network if ``a`` is input."""
+        a = np.asarray(a, dtype=self.dtype)
         for b, w in zip(self.biases, self.weights):
             a = sigmoid(np.dot(w, a)+b)
         return a
 
+    def predict_proba(self, X, chunk_size=1000):
+        """Return a tuple ``(proba, labels)`` with the class
+        probabilities, of shape ``(N, n_out)``, and the most likely
+        class of each of the ``N`` inputs.  The probabilities are the
+        output activations normalized to sum to one.  ``X`` is either
+        an array (or a memory map, e.g. from ``np.load(...,
+        mmap_mode="r")``) with one input per row, or any iterable of
+        inputs, such as the list returned by ``generate_Ising_data`` or
+        a generator; each of its items may be a single input, as a row
+        or column vector, or a block of rows.  The inputs are fed
+        forward ``chunk_size`` at a time, so the memory used does not
+        grow with the number of inputs beyond the result itself.
+        """
+        if isinstance(X, np.ndarray):
+            # each item along the first axis is one input, as a row or
+            # column vector, like the items of an iterable
+            n_in = int(np.prod(X.shape[1:]))
+            chunks = (X[k:k+chunk_size].reshape(-1, n_in)
+                      for k in range(0, len(X), chunk_size))
+        else:
+            chunks = iter_chunks(X, chunk_size, self.dtype)
+        probas = []
+        for chunk in chunks:
+            a = self.feedforward(chunk.T)
+            probas.append((a/a.sum(axis=0)).T)
+        if not probas:
+            return np.empty((0, self.sizes[-1]), self.dtype), \
+                np.empty(0, dtype=int)
+        proba = np.concatenate(probas)
+        return proba, np.argmax(proba, axis=1)
+
     def SGD(self, training_data, epochs, mini_batch_size, eta,
             lmbda = 0.0,
             evaluation_data=None,
             monitor_evaluation_cost=False,
             monitor_evaluation_accuracy=False,
             monitor_training_cost=False,
-            monitor_training_accuracy=False):
+            monitor_training_accuracy=False,
+            preallocate=True,
+            processes=1,
+            async_monitoring=False,
+            optimizer=None,
+            monitor_every=1,
+            early_stopping=None,
+            patience=10,
+            min_delta=0.0,
+            profiler=None):
         """Train the neural network using mini-batch stochastic gradient
-        descent.  The ``training_data`` is a list of tuples ``(x, y)``
-        representing the training inputs and the desired outputs.  The
+        descent.  The ``training_data`` is a tuple ``(X, Y)`` of two
+        contiguous arrays of shape ``(N, n_in)`` and ``(N, n_out)``
+        holding the training inputs and the desired outputs, one
+        sample per row (a legacy list of tuples ``(x, y)`` is converted
+        with ``as_arrays``).  The training set is shuffled once per
+        epoch by drawing a permutation of the row indices, and each
+        mini-batch is gathered from it by fancy indexing.  The
         other non-optional parameters are self-explanatory, as is the
         regularization parameter ``lmbda``.  The method also accepts
         ``evaluation_data``, usually either the validation or test
@@ -135,67 +386,316 @@ class Network(object):
         will be a 30-element list containing the cost on the
         evaluation data at the end of each epoch. Note that the lists
         are empty if the corresponding flag is not set.
+        If ``preallocate`` is set, the mini-batches, activations,
+        deltas and gradients live in buffers allocated once per batch
+        size (see ``Workspace``) and the weights and biases are updated
+        in place, so the training loop itself allocates (almost) no
+        memory.  With ``processes`` > 1 each mini-batch is split across
+        that many worker processes instead (see ``DataParallel``); this
+        only pays off for large mini-batches.
+        If ``async_monitoring`` is set, the monitoring at the end of
+        each epoch runs on a background thread: the weights are copied
+        into one of two snapshot buffers and training carries on while
+        the snapshot is evaluated.  The metric lists are still filled in
+        epoch order, and are complete when ``SGD`` returns.
+        ``eta`` may also be a learning-rate schedule, such as
+        ``CosineDecay``, called with the fractional epoch before each
+        mini-batch.  The epochs are counted in ``self.epoch`` across
+        calls, so a schedule continues where the last call stopped.
+        ``optimizer`` (e.g. ``Momentum()`` or ``Adam()``) replaces the
+        plain gradient descent step; it is kept in ``self.optimizer``,
+        so later calls without one go on with it, and it is saved in
+        checkpoints together with its state.
+        The monitoring runs every ``monitor_every`` epochs and after
+        the last one.  If ``early_stopping`` names one of the metrics
+        (``"evaluation_accuracy"``, ``"evaluation_cost"``,
+        ``"training_accuracy"`` or ``"training_cost"``; its flag is
+        then set automatically), training stops once the metric has not
+        improved by more than ``min_delta`` (in the units of the metric
+        lists) for ``patience`` consecutive evaluations.  The weights
+        with the best value are kept in memory and restored at the end,
+        and the epoch they belong to is stored in ``self.best_epoch``.
+        With ``async_monitoring`` the stop may come a couple of epochs
+        late, which the restore makes harmless.
+        A ``Profiler`` passed as ``profiler`` records the time spent in
+        each phase of every epoch; see there.
         """
-        if evaluation_data: n_data = len(evaluation_data)
-        n = len(training_data)
+        # cast once, so that the mini-batches match the weights' dtype
+        X, Y = as_arrays(training_data)
+        training_data = X, Y = \
+            np.asarray(X, dtype=self.dtype), np.asarray(Y, dtype=self.dtype)
+        if evaluation_data is not None:
+            evaluation_data = as_arrays(evaluation_data)
+            n_data = len(evaluation_data[0])
+        n = len(X)
         evaluation_cost, evaluation_accuracy = [], []
         training_cost, training_accuracy = [], []
-        for j in range(epochs):
-            random.shuffle(training_data)
-            mini_batches = [
-                training_data[k:k+mini_batch_size]
-                for k in range(0, n, mini_batch_size)]
-            for mini_batch in mini_batches:
-                self.update_mini_batch(
-                    mini_batch, eta, lmbda, len(training_data))
-            print("Epoch %s training complete" % j)
+        if optimizer is not None:
+            self.optimizer = optimizer
+        schedule = eta if callable(eta) else None
+        first_epoch = self.epoch
+        if early_stopping is not None:
+            if early_stopping == "evaluation_accuracy":
+                monitor_evaluation_accuracy = True
+            elif early_stopping == "evaluation_cost":
+                monitor_evaluation_cost = True
+            elif early_stopping == "training_accuracy":
+                monitor_training_accuracy = True
+            elif early_stopping == "training_cost":
+                monitor_training_cost = True
+            else:
+                raise ValueError("unknown metric for early stopping: "
+                                 "{}".format(early_stopping))
+            # costs improve downwards, accuracies upwards
+            sign = 1 if early_stopping.endswith("accuracy") else -1
+            best = self.snapshot()
+            stopping = {"best": None, "wait": 0, "stop": False}
+            self.best_epoch = None
+        def monitor(net, j):
+            # each data set is evaluated at most once per epoch, and
+            # the cost and accuracy are taken from the same pass
+            if monitor_training_cost or monitor_training_accuracy:
+                cost, accuracy = net.evaluate(training_data, lmbda)
             if monitor_training_cost:
-                cost = self.total_cost(training_data, lmbda)
                 training_cost.append(cost)
                 print("Cost on training data: {}".format(cost))
             if monitor_training_accuracy:
-                accuracy = self.accuracy(training_data, convert=True)
                 training_accuracy.append(accuracy)
                 print("Accuracy on training data: {} / {}".format(
                     accuracy, n))
+            if monitor_evaluation_cost or monitor_evaluation_accuracy:
+                cost, accuracy = net.evaluate(evaluation_data, lmbda)
             if monitor_evaluation_cost:
-                cost = self.total_cost(evaluation_data, lmbda, convert=True)
                 evaluation_cost.append(cost)
                 print("Cost on evaluation data: {}".format(cost))
             if monitor_evaluation_accuracy:
-                accuracy = self.accuracy(evaluation_data)
                 evaluation_accuracy.append(accuracy)
                 print("Accuracy on evaluation data: {} / {}".format(
-                    self.accuracy(evaluation_data), n_data))
+                    accuracy, n_data))
+            if early_stopping is None:
+                return
+            value = {"evaluation_accuracy": evaluation_accuracy,
+                     "evaluation_cost": evaluation_cost,
+                     "training_accuracy": training_accuracy,
+                     "training_cost": training_cost}[early_stopping][-1]
+            if stopping["best"] is None or \
+                    sign*(value-stopping["best"]) > min_delta:
+                stopping["best"], stopping["wait"] = value, 0
+                net.snapshot(out=best)
+                self.best_epoch = first_epoch+j+1
+            else:
+                stopping["wait"] += 1
+                if stopping["wait"] >= patience:
+                    stopping["stop"] = True
+        if async_monitoring:
+            # a single worker evaluates the snapshots in epoch order;
+            # each of the two snapshots is reused once the evaluation
+            # submitted before the last one has finished
+            executor = ThreadPoolExecutor(max_workers=1)
+            snapshots = [self.snapshot(), self.snapshot()]
+            futures = []
+        parallel = DataParallel(self, X, Y, processes) \
+            if processes > 1 else None
+        self.profiler = profiler
+        try:
+            for j in range(epochs):
+                if profiler is not None:
+                    profiler.begin_epoch()
+                permutation = np.random.permutation(n)
+                if parallel is not None:
+                    parallel.set_permutation(permutation)
+                if profiler is not None:
+                    profiler.tick("shuffle")
+                for k in range(0, n, mini_batch_size):
+                    if schedule is not None:
+                        eta = schedule(self.epoch+k/n)
+                    if parallel is not None:
+                        parallel.update_mini_batch(
+                            k, min(k+mini_batch_size, n), eta, lmbda, n)
+                        continue
+                    batch = permutation[k:k+mini_batch_size]
+                    if preallocate:
+                        ws = self.workspace(len(batch), X.dtype, Y.dtype)
+                        np.take(X, batch, axis=0, out=ws.x)
+                        np.take(Y, batch, axis=0, out=ws.y)
+                        mini_batch = (ws.x, ws.y)
+                    else:
+                        ws = None
+                        mini_batch = (X[batch], Y[batch])
+                    if profiler is not None:
+                        profiler.tick("gather")
+                    self.update_mini_batch(mini_batch, eta, lmbda, n,
+                                           workspace=ws)
+                self.epoch += 1
+                print("Epoch %s training complete" % j)
+                if (j+1) % monitor_every == 0 or j == epochs-1:
+                    if not async_monitoring:
+                        monitor(self, j)
+                    else:
+                        if len(futures) >= 2:
+                            futures[-2].result()
+                        snapshot = snapshots[len(futures) % 2]
+                        self.snapshot(out=snapshot)
+                        futures.append(executor.submit(monitor, snapshot, j))
+                    if profiler is not None:
+                        profiler.tick("monitoring")
+                if profiler is not None:
+                    profiler.end_epoch(self.epoch, n)
+                if early_stopping is not None and stopping["stop"]:
+                    print("Early stopping: no improvement in {} for {} "
+                          "evaluations".format(early_stopping, patience))
+                    break
+        finally:
+            self.profiler = None
+            if profiler is not None:
+                profiler.close()
+            if parallel is not None:
+                parallel.close()
+            if async_monitoring:
+                executor.shutdown(wait=True)
+        if async_monitoring:
+            for future in futures:
+                future.result() # re-raise errors from the worker
+        if early_stopping is not None and stopping["best"] is not None:
+            best.snapshot(out=self)
+            print("Restored the weights of epoch {} ({} = {})".format(
+                self.best_epoch, early_stopping, stopping["best"]))
 
         return evaluation_cost, evaluation_accuracy, \
             training_cost, training_accuracy
 
-    def update_mini_batch(self, mini_batch, eta, lmbda, n):
+    def config(self):
+        """Return the keyword arguments, besides ``sizes``, ``cost``
+        and ``dtype``, needed to recreate a network of this kind.  They
+        are stored in checkpoints."""
+        return {}
+
+    def snapshot(self, out=None):
+        """Return a copy of the network with its own copies of the
+        weights and biases, for evaluating while training continues.
+        If ``out`` is a snapshot taken earlier, the parameters are
+        copied into its arrays instead of allocating new ones."""
+        if out is None:
+            out = copy.copy(self)
+            out.weights = [w.copy() for w in self.weights]
+            out.biases = [b.copy() for b in self.biases]
+            out.workspaces = {}
+            return out
+        for dst, src in zip(out.weights + out.biases,
+                            self.weights + self.biases):
+            np.copyto(dst, src)
+        return out
+
+    def workspace(self, m, x_dtype=None, y_dtype=None):
+        """Return the ``Workspace`` for mini-batches of size ``m``,
+        allocating it on first use.  Workspaces are cached per batch
+        size and dtype, so an epoch needs at most two of them (the
+        last mini-batch may be smaller).  The dtypes of the mini-batch
+        buffers default to the network's ``dtype``."""
+        x_dtype = self.dtype if x_dtype is None else x_dtype
+        y_dtype = self.dtype if y_dtype is None else y_dtype
+        key = (m, np.dtype(x_dtype), np.dtype(y_dtype),
+               self.weights[0].dtype)
+        if key not in self.workspaces:
+            self.workspaces[key] = Workspace(self, m, x_dtype, y_dtype)
+        return self.workspaces[key]
+
+    def update_mini_batch(self, mini_batch, eta, lmbda, n, workspace=None):
         """Update the network's weights and biases by applying gradient
         descent using backpropagation to a single mini batch.  The
-        ``mini_batch`` is a list of tuples ``(x, y)``, ``eta`` is the
-        learning rate, ``lmbda`` is the regularization parameter, and
-        ``n`` is the total size of the training data set.
+        ``mini_batch`` is a tuple ``(X, Y)`` of arrays holding one
+        sample per row, ``eta`` is the learning rate, ``lmbda`` is the
+        regularization parameter, and ``n`` is the total size of the
+        training data set.  If a ``workspace`` for the batch size is
+        given, backpropagation runs in its buffers and the parameters
+        are updated in place.
         """
-        nabla_b = [np.zeros(b.shape) for b in self.biases]
-        nabla_w = [np.zeros(w.shape) for w in self.weights]
-        for x, y in mini_batch:
-            delta_nabla_b, delta_nabla_w = self.backprop(x, y)
-            nabla_b = [nb+dnb for nb, dnb in zip(nabla_b, delta_nabla_b)]
-            nabla_w = [nw+dnw for nw, dnw in zip(nabla_w, delta_nabla_w)]
-        self.weights = [(1-eta*(lmbda/n))*w-(eta/len(mini_batch))*nw
-                        for w, nw in zip(self.weights, nabla_w)]
-        self.biases = [b-(eta/len(mini_batch))*nb
-                       for b, nb in zip(self.biases, nabla_b)]
+        X, Y = mini_batch
+        m = len(X)
+        if workspace is None and self.optimizer is None:
+            nabla_b, nabla_w = self.backprop(X.T, Y.T)
+            self.weights = [(1-eta*(lmbda/n))*w-(eta/m)*nw
+                            for w, nw in zip(self.weights, nabla_w)]
+            self.biases = [b-(eta/m)*nb
+                           for b, nb in zip(self.biases, nabla_b)]
+            if self.profiler is not None:
+                self.profiler.tick("update")
+            return
+        if workspace is None:
+            nabla_b, nabla_w = self.backprop(X.T, Y.T)
+        else:
+            nabla_b, nabla_w = self.backprop_into(X, Y, workspace)
+        self.update_parameters(nabla_b, nabla_w, eta, lmbda, m, n)
+
+    def update_parameters(self, nabla_b, nabla_w, eta, lmbda, m, n):
+        """Apply one gradient descent step in place, given the gradients
+        ``nabla_b`` and ``nabla_w`` summed over a mini-batch of size
+        ``m``.  The gradient arrays are used as scratch and overwritten.
+        The step is taken by ``self.optimizer`` if one is set.
+        """
+        if self.optimizer is not None:
+            grads = nabla_w + nabla_b
+            for g in grads:
+                g *= 1.0/m
+            decays = [lmbda/n]*len(nabla_w) + [0.0]*len(nabla_b)
+            self.optimizer.update(self.weights + self.biases, grads,
+                                  decays, eta)
+        else:
+            for w, nw in zip(self.weights, nabla_w):
+                w *= 1-eta*(lmbda/n)
+                nw *= eta/m
+                w -= nw
+            for b, nb in zip(self.biases, nabla_b):
+                nb *= eta/m
+                b -= nb
+        if self.profiler is not None:
+            self.profiler.tick("update")
+
+    def backprop_into(self, X, Y, ws):
+        """Same as ``backprop`` for a mini-batch ``(X, Y)`` with one
+        sample per row, but every intermediate result is written into
+        the buffers of the ``Workspace`` ``ws``.  Returns the lists
+        ``(ws.nabla_b, ws.nabla_w)``, which are overwritten by the
+        next call."""
+        # feedforward
+        activation = X.T
+        for b, w, z, a, sp, mask in zip(self.biases, self.weights, ws.zs,
+                                        ws.activations, ws.sp, ws.mask):
+            np.dot(w, activation, out=z)
+            z += b
+            sigmoid(z, out=a, scratch=sp, mask=mask)
+            activation = a
+        if self.profiler is not None:
+            self.profiler.tick("forward")
+        # backward pass
+        delta = ws.deltas[-1]
+        self.cost.delta(ws.zs[-1], ws.activations[-1], Y.T, out=delta)
+        for l in range(1, self.num_layers):
+            if l > 1:
+                # sigma'(z) = sigma(z)*(1-sigma(z)), from the stored activation
+                a, sp = ws.activations[-l], ws.sp[-l]
+                np.dot(self.weights[-l+1].T, delta, out=ws.deltas[-l])
+                delta = ws.deltas[-l]
+                np.subtract(1, a, out=sp)
+                sp *= a
+                delta *= sp
+            a_prev = ws.activations[-l-1] if l < self.num_layers-1 else X.T
+            np.sum(delta, axis=1, keepdims=True, out=ws.nabla_b[-l])
+            np.dot(delta, a_prev.T, out=ws.nabla_w[-l])
+        if self.profiler is not None:
+            self.profiler.tick("backprop")
+        return (ws.nabla_b, ws.nabla_w)
 
     def backprop(self, x, y):
         """Return a tuple ``(nabla_b, nabla_w)`` representing the
         gradient for the cost function C_x.  ``nabla_b`` and
         ``nabla_w`` are layer-by-layer lists of numpy arrays, similar
-        to ``self.biases`` and ``self.weights``."""
-        nabla_b = [np.zeros(b.shape) for b in self.biases]
-        nabla_w = [np.zeros(w.shape) for w in self.weights]
+        to ``self.biases`` and ``self.weights``.  ``x`` and ``y`` may
+        also hold a whole mini-batch as columns, of shape ``(n_in, m)``
+        and ``(n_out, m)``, in which case the returned gradients are
+        summed over the ``m`` samples."""
+        nabla_b = [np.zeros(b.shape, dtype=b.dtype) for b in self.biases]
+        nabla_w = [np.zeros(w.shape, dtype=w.dtype) for w in self.weights]
         # feedforward
         activation = x
         activations = [x] # list to store all the activations, layer by layer
@@ -205,9 +705,11 @@ class Network(object):
             zs.append(z)
             activation = sigmoid(z)
             activations.append(activation)
+        if self.profiler is not None:
+            self.profiler.tick("forward")
         # backward pass
         delta = (self.cost).delta(zs[-1], activations[-1], y)
-        nabla_b[-1] = delta
+        nabla_b[-1] = delta.sum(axis=1, keepdims=True)
         nabla_w[-1] = np.dot(delta, activations[-2].transpose())
         # Note that the variable l in the loop below is used a little
         # differently to the notation in Chapter 2 of the book.  Here,
@@ -216,82 +718,728 @@ class Network(object):
         # scheme in the book, used here to take advantage of the fact
         # that Python can use negative indices in lists.
         for l in range(2, self.num_layers):
-            z = zs[-l]
-            sp = sigmoid_prime(z)
+            a = activations[-l]
+            sp = a*(1-a) # sigma'(z), from the stored activation
             delta = np.dot(self.weights[-l+1].transpose(), delta) * sp
-            nabla_b[-l] = delta
+            nabla_b[-l] = delta.sum(axis=1, keepdims=True)
             nabla_w[-l] = np.dot(delta, activations[-l-1].transpose())
+        if self.profiler is not None:
+            self.profiler.tick("backprop")
         return (nabla_b, nabla_w)
 
+    def evaluate(self, data, lmbda=0.0, chunk_size=1000):
+        """Return a tuple ``(cost, accuracy)`` for the data set ``data``
+        computed in a single pass: the total cost (including the L2
+        regularization term for ``lmbda``) and the number of inputs for
+        which the network outputs the correct result.  The inputs are
+        fed forward ``chunk_size`` samples at a time as matrices, so
+        the memory used stays bounded for large data sets.  The desired
+        outputs in ``data`` may either be one-hot rows (as in the
+        training data) or integer labels (as in the test data); see
+        ``load_data_wrapper``.
+        """
+        X, Y = as_arrays(data)
+        n = len(X)
+        cost, accuracy = 0.0, 0
+        for k in range(0, n, chunk_size):
+            a = self.feedforward(X[k:k+chunk_size].T)
+            y = Y[k:k+chunk_size]
+            if y.ndim == 1:
+                labels = y
+                y = np.eye(a.shape[0], dtype=a.dtype)[y]
+            else:
+                labels = np.argmax(y, axis=1)
+            cost += float(self.cost.fn(a, y.T))/n
+            accuracy += int(np.sum(np.argmax(a, axis=0) == labels))
+        cost += 0.5*(lmbda/n)*sum(
+            float(np.linalg.norm(w))**2 for w in self.weights)
+        return cost, accuracy
+
     def accuracy(self, data, convert=False):
         """Return the number of inputs in ``data`` for which the neural
         network outputs the correct result. The neural network's
         output is assumed to be the index of whichever neuron in the
-        final layer has the highest activation.
-        The flag ``convert`` should be set to False if the data set is
-        validation or test data (the usual case), and to True if the
-        data set is the training data. The need for this flag arises
-        due to differences in the way the results ``y`` are
-        represented in the different data sets.  In particular, it
-        flags whether we need to convert between the different
-        representations.  It may seem strange to use different
-        representations for the different data sets.  Why not use the
-        same representation for all three data sets?  It's done for
-        efficiency reasons -- the program usually evaluates the cost
-        on the training data and the accuracy on other data sets.
-        These are different types of computations, and using different
-        representations speeds things up.  More details on the
-        representations can be found in
-        mnist_loader.load_data_wrapper.
+        final layer has the highest activation.  The flag ``convert``
+        is kept for compatibility only: whether the desired outputs
+        are one-hot vectors or integer labels is read off the shape of
+        ``data``.  See ``evaluate``, which computes the cost in the
+        same pass.
         """
-        if convert:
-            results = [(np.argmax(self.feedforward(x)), np.argmax(y))
-                       for (x, y) in data]
-        else:
-            results = [(np.argmax(self.feedforward(x)), y)
-                        for (x, y) in data]
-        return sum(int(x == y) for (x, y) in results)
+        return self.evaluate(data)[1]
 
     def total_cost(self, data, lmbda, convert=False):
-        """Return the total cost for the data set ``data``.  The flag
-        ``convert`` should be set to False if the data set is the
-        training data (the usual case), and to True if the data set is
-        the validation or test data.  See comments on the similar (but
-        reversed) convention for the ``accuracy`` method, above.
+        """Return the total cost for the data set ``data``.  As for
+        ``accuracy``, the flag ``convert`` is kept for compatibility
+        only.  See ``evaluate``.
         """
-        cost = 0.0
-        for x, y in data:
-            a = self.feedforward(x)
-            if convert: y = vectorized_result(y)
-            cost += self.cost.fn(a, y)/len(data)
-        cost += 0.5*(lmbda/len(data))*sum(
-            np.linalg.norm(w)**2 for w in self.weights)
-        return cost
+        return self.evaluate(data, lmbda)[0]
 
-    def save(self, filename):
-        """Save the neural network to the file ``filename``."""
-        data = {"sizes": self.sizes,
-                "weights": [w.tolist() for w in self.weights],
-                "biases": [b.tolist() for b in self.biases],
-                "cost": str(self.cost.__name__)}
-        f = open(filename, "w")
-        json.dump(data, f)
-        f.close()
+    def save(self, filename, format="npz"):
+        """Save the neural network to the file ``filename``.  The
+        default ``format="npz"`` writes an uncompressed ``.npz`` archive
+        holding the weights ``w0, w1, ...`` and biases ``b0, b1, ...``
+        as raw binary arrays, plus a small JSON metadata header
+        ``meta``; see ``load``.  ``format="json"`` writes the legacy
+        JSON format with the parameters as nested lists.
+
+        The file is written to a temporary file in the same directory
+        and then moved over ``filename``, so a network loaded from
+        ``filename`` with ``mmap_mode`` can be saved back to it.
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                   suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                self.write_checkpoint(f, format)
+            # mkstemp creates the file readable by its owner only
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def write_checkpoint(self, f, format="npz"):
+        """Write the checkpoint in ``format`` to the binary file object
+        ``f``; see ``save``."""
+        if format == "json":
+            data = {"sizes": self.sizes,
+                    "weights": [w.tolist() for w in self.weights],
+                    "biases": [b.tolist() for b in self.biases],
+                    "cost": str(self.cost.__name__),
+                    "dtype": self.dtype.name}
+            f.write(json.dumps(data).encode())
+            return
+        meta = {"format": CHECKPOINT_VERSION,
+                "sizes": list(self.sizes),
+                "cost": str(self.cost.__name__),
+                "dtype": self.dtype.name,
+                "epoch": self.epoch,
+                "network": type(self).__name__,
+                "config": self.config()}
+        arrays = {}
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            arrays["w%d" % i] = w
+            arrays["b%d" % i] = b
+        if self.optimizer is not None:
+            meta["optimizer"] = {"name": type(self.optimizer).__name__,
+                                 "config": self.optimizer.config()}
+            for key, a in self.optimizer.state().items():
+                arrays["opt_" + key] = a
+        arrays["meta"] = np.array(json.dumps(meta))
+        np.savez(f, **arrays)
+
+class ConvNetwork(Network):
+    """A network for L x L lattices whose first layer is convolutional.
+    ``sizes[0]`` is the number L*L of sites of the training lattices
+    and ``sizes[1]`` the number of filters; the remaining layers are
+    fully connected as in ``Network``.  Each filter is a
+    ``kernel_size`` x ``kernel_size`` stencil applied at every site,
+    with periodic boundary conditions, followed by the sigmoid and a
+    global average over the lattice.  The filters are translation
+    invariant and the pooled features do not depend on L, so a
+    trained network can classify lattices of any size (given as
+    arrays with L*L columns to ``feedforward`` or ``predict_proba``).
+    The filters and their biases are ``weights[0]``, of shape
+    ``(filters, kernel_size**2)``, and ``biases[0]``, so ``SGD``, the
+    optimizers and checkpoints handle them like any other layer.  The
+    convolution is done by im2col: the patches around every site are
+    gathered with a precomputed periodic index, and the filters are
+    applied to them as one matrix product.
+    """
+    def __init__(self, sizes, kernel_size=3, cost=CrossEntropyCost,
+                 dtype=np.float32):
+        self.kernel_size = kernel_size
+        self.patch_indices = {}
+        Network.__init__(self, sizes, cost=cost, dtype=dtype)
+
+    def config(self):
+        return {"kernel_size": self.kernel_size}
+
+    def default_weight_initializer(self):
+        """As for ``Network``, with each filter weight scaled by one
+        over the square root of the size of the stencil."""
+        Network.default_weight_initializer(self)
+        k2 = self.kernel_size**2
+        self.weights[0] = (np.random.randn(self.sizes[1], k2)/np.sqrt(k2)
+                           ).astype(self.dtype)
+
+    def large_weight_initializer(self):
+        Network.large_weight_initializer(self)
+        self.weights[0] = np.random.randn(
+            self.sizes[1], self.kernel_size**2).astype(self.dtype)
+
+    def patches(self, X):
+        """Return the array ``(m, L*L, kernel_size**2)`` of the periodic
+        patches around every site of the ``m`` lattices in the rows of
+        ``X``."""
+        L = int(round(np.sqrt(X.shape[1])))
+        if L not in self.patch_indices:
+            self.patch_indices[L] = periodic_patch_index(L, self.kernel_size)
+        return X[:, self.patch_indices[L]]
+
+    def convolve(self, X):
+        """Return ``(cols, a, p)``: the patches of the lattices in the
+        rows of ``X``, the activations ``(m, L*L, filters)`` of the
+        convolutional layer and their averages ``(filters, m)`` over
+        the lattice."""
+        cols = self.patches(np.asarray(X, dtype=self.dtype))
+        a = sigmoid(np.matmul(cols, self.weights[0].T)+self.biases[0].T)
+        return cols, a, a.mean(axis=1).T
+
+    def feedforward(self, a):
+        """Return the output of the network if ``a`` is input, with one
+        lattice per column."""
+        a = self.convolve(np.asarray(a).T)[2]
+        for b, w in zip(self.biases[1:], self.weights[1:]):
+            a = sigmoid(np.dot(w, a)+b)
+        return a
+
+    def backprop(self, x, y):
+        """Same as ``Network.backprop``; the gradient of the filters is
+        summed over all sites and patches."""
+        nabla_b = [np.zeros(b.shape, dtype=b.dtype) for b in self.biases]
+        nabla_w = [np.zeros(w.shape, dtype=w.dtype) for w in self.weights]
+        # feedforward
+        cols, conv_a, activation = self.convolve(np.asarray(x).T)
+        activations = [x, activation]
+        zs = [None]
+        for b, w in zip(self.biases[1:], self.weights[1:]):
+            z = np.dot(w, activation)+b
+            zs.append(z)
+            activation = sigmoid(z)
+            activations.append(activation)
+        if self.profiler is not None:
+            self.profiler.tick("forward")
+        # backward pass through the fully connected layers
+        delta = (self.cost).delta(zs[-1], activations[-1], y)
+        for l in range(1, self.num_layers-1):
+            if l > 1:
+                a = activations[-l]
+                delta = np.dot(self.weights[-l+1].transpose(), delta)*a*(1-a)
+            nabla_b[-l] = delta.sum(axis=1, keepdims=True)
+            nabla_w[-l] = np.dot(delta, activations[-l-1].transpose())
+        # through the global average and the convolution; the pooled
+        # features enter the next layer without a nonlinearity
+        n_sites = conv_a.shape[1]
+        delta = np.dot(self.weights[1].transpose(), delta).T[:, None, :] \
+            * conv_a*(1-conv_a)/n_sites
+        delta = delta.reshape(-1, delta.shape[2])
+        nabla_b[0] = delta.sum(axis=0)[:, None]
+        nabla_w[0] = np.dot(delta.T, cols.reshape(-1, cols.shape[2]))
+        if self.profiler is not None:
+            self.profiler.tick("backprop")
+        return (nabla_b, nabla_w)
+
+    def backprop_into(self, X, Y, ws):
+        """Same as ``Network.backprop_into``.  The convolutional layer
+        has no preallocated buffers, only the gradients are written
+        into the workspace."""
+        nabla_b, nabla_w = self.backprop(X.T, Y.T)
+        for dst, src in zip(ws.nabla_b + ws.nabla_w, nabla_b + nabla_w):
+            np.copyto(dst, src)
+        return (ws.nabla_b, ws.nabla_w)
+
+class Ensemble(object):
+    """``K`` networks with the same ``sizes`` trained together, e.g.
+    with different seeds or learning rates to put error bars on the
+    phase diagram.  The parameters of layer ``l`` are stacked into
+    ``weights[l]`` of shape ``(K, out, in)`` and ``biases[l]`` of shape
+    ``(K, out, 1)``, so every member is fed forward and backpropagated
+    on the same mini-batch by one batched ``np.matmul`` per layer
+    instead of ``K`` separate ones.  If ``seeds`` is given, member
+    ``k`` is initialized from ``np.random.RandomState(seeds[k])``.
+    ``member(k)`` returns an ordinary ``Network`` viewing the
+    parameters of member ``k``, e.g. to save it.
+    """
+    def __init__(self, sizes, K, cost=CrossEntropyCost, dtype=np.float32,
+                 seeds=None):
+        self.num_layers = len(sizes)
+        self.sizes = sizes
+        self.K = K
+        self.cost = cost
+        self.dtype = np.dtype(dtype)
+        rngs = [np.random.RandomState(seed) for seed in seeds] \
+            if seeds is not None else [np.random]*K
+        self.biases = [np.stack([rng.randn(y, 1) for rng in rngs])
+                       .astype(self.dtype) for y in sizes[1:]]
+        self.weights = [np.stack([rng.randn(y, x)/np.sqrt(x) for rng in rngs])
+                        .astype(self.dtype)
+                        for x, y in zip(sizes[:-1], sizes[1:])]
+
+    def member(self, k):
+        """Return member ``k`` as a ``Network`` sharing the parameters."""
+        net = Network(self.sizes, cost=self.cost, dtype=self.dtype)
+        net.weights = [w[k] for w in self.weights]
+        net.biases = [b[k] for b in self.biases]
+        return net
+
+    def feedforward(self, a):
+        """Return the outputs ``(K, n_out, m)`` of all members for the
+        inputs ``a``, one per column."""
+        a = np.asarray(a, dtype=self.dtype)
+        for b, w in zip(self.biases, self.weights):
+            a = sigmoid(np.matmul(w, a)+b)
+        return a
+
+    def SGD(self, training_data, epochs, mini_batch_size, eta,
+            lmbda=0.0, evaluation_data=None,
+            monitor_evaluation_accuracy=False):
+        """Train all members by mini-batch stochastic gradient descent
+        on the same shuffled mini-batches.  ``eta`` and ``lmbda`` are
+        either numbers or sequences with one value per member.  Returns
+        the list of per-epoch accuracies on ``evaluation_data``, each an
+        array with one count per member (empty unless
+        ``monitor_evaluation_accuracy`` is set).
+        """
+        X, Y = as_arrays(training_data)
+        X, Y = np.asarray(X, dtype=self.dtype), np.asarray(Y, dtype=self.dtype)
+        n = len(X)
+        eta = np.reshape(np.asarray(eta, dtype=self.dtype), (-1, 1, 1))
+        lmbda = np.reshape(np.asarray(lmbda, dtype=self.dtype), (-1, 1, 1))
+        evaluation_accuracy = []
+        for j in range(epochs):
+            permutation = np.random.permutation(n)
+            for k in range(0, n, mini_batch_size):
+                batch = permutation[k:k+mini_batch_size]
+                m = len(batch)
+                nabla_b, nabla_w = self.backprop(X[batch].T, Y[batch].T)
+                for w, nw in zip(self.weights, nabla_w):
+                    w *= 1-eta*(lmbda/n)
+                    nw *= eta/m
+                    w -= nw
+                for b, nb in zip(self.biases, nabla_b):
+                    nb *= eta/m
+                    b -= nb
+            print("Epoch %s training complete" % j)
+            if monitor_evaluation_accuracy:
+                accuracy = self.evaluate(evaluation_data)[1]
+                evaluation_accuracy.append(accuracy)
+                print("Accuracy on evaluation data: {} / {}".format(
+                    accuracy, len(evaluation_data[0])))
+        return evaluation_accuracy
+
+    def backprop(self, x, y):
+        """Return ``(nabla_b, nabla_w)`` stacked like ``self.biases``
+        and ``self.weights``: the gradients of each member's cost,
+        summed over the mini-batch ``x``, ``y`` (one sample per
+        column) that all members share."""
+        activations, zs = [np.asarray(x, dtype=self.dtype)], []
+        for b, w in zip(self.biases, self.weights):
+            zs.append(np.matmul(w, activations[-1])+b)
+            activations.append(sigmoid(zs[-1]))
+        nabla_b, nabla_w = [None]*len(self.biases), [None]*len(self.weights)
+        delta = (self.cost).delta(zs[-1], activations[-1], y)
+        for l in range(1, self.num_layers):
+            if l > 1:
+                a = activations[-l]
+                delta = np.matmul(self.weights[-l+1].transpose(0, 2, 1),
+                                  delta)*a*(1-a)
+            nabla_b[-l] = delta.sum(axis=2, keepdims=True)
+            # the input activations are shared, (in, m), for l = L-1
+            nabla_w[-l] = np.matmul(delta, np.swapaxes(activations[-l-1],
+                                                       -1, -2))
+        return (nabla_b, nabla_w)
+
+    def evaluate(self, data, lmbda=0.0, chunk_size=1000):
+        """Return ``(cost, accuracy)``, two arrays with the value of
+        each member, as ``Network.evaluate``."""
+        X, Y = as_arrays(data)
+        n = len(X)
+        cost = np.zeros(self.K)
+        accuracy = np.zeros(self.K, dtype=int)
+        for k in range(0, n, chunk_size):
+            a = self.feedforward(X[k:k+chunk_size].T)
+            y = Y[k:k+chunk_size]
+            if y.ndim == 1:
+                labels = y
+                y = np.eye(a.shape[1], dtype=a.dtype)[y]
+            else:
+                labels = np.argmax(y, axis=1)
+            cost += [float(self.cost.fn(a_k, y.T))/n for a_k in a]
+            accuracy += np.sum(np.argmax(a, axis=1) == labels, axis=1)
+        cost += 0.5*(np.ravel(lmbda)/n)*sum(
+            np.sum(np.square(w, dtype=np.float64), axis=(1, 2))
+            for w in self.weights)
+        return cost, accuracy
+
+    def predict_proba(self, X, chunk_size=1000):
+        """Return ``(proba, mean, labels)``: the class probabilities of
+        every member, of shape ``(K, N, n_out)``, their average over the
+        members and the most likely class according to the average.
+        ``X`` may be anything ``Network.predict_proba`` accepts."""
+        if isinstance(X, np.ndarray):
+            # each item along the first axis is one input, as a row or
+            # column vector, like the items of an iterable
+            n_in = int(np.prod(X.shape[1:]))
+            chunks = (X[k:k+chunk_size].reshape(-1, n_in)
+                      for k in range(0, len(X), chunk_size))
+        else:
+            chunks = iter_chunks(X, chunk_size, self.dtype)
+        probas = []
+        for chunk in chunks:
+            a = self.feedforward(chunk.T)
+            probas.append((a/a.sum(axis=1, keepdims=True)).transpose(0, 2, 1))
+        if not probas:
+            probas = [np.empty((self.K, 0, self.sizes[-1]), self.dtype)]
+        proba = np.concatenate(probas, axis=1)
+        mean = proba.mean(axis=0)
+        return proba, mean, np.argmax(mean, axis=1)
+
+class Workspace(object):
+    """Preallocated buffers for training ``net`` on mini-batches of
+    ``m`` samples: the gathered mini-batch ``x`` and ``y`` (one sample
+    per row), and per layer the weighted inputs ``zs``, the
+    activations, the error deltas, the scratch ``sp`` for the sigmoid
+    derivative (also used by the sigmoid itself, together with the
+    boolean ``mask``), and the gradients ``nabla_b`` and ``nabla_w``.  The
+    layer-by-layer lists are indexed like ``net.biases``.
+    """
+    def __init__(self, net, m, x_dtype=None, y_dtype=None):
+        dtype = net.weights[0].dtype
+        x_dtype = dtype if x_dtype is None else x_dtype
+        y_dtype = dtype if y_dtype is None else y_dtype
+        self.m = m
+        self.x = np.empty((m, net.sizes[0]), dtype=x_dtype)
+        self.y = np.empty((m, net.sizes[-1]), dtype=y_dtype)
+        self.zs = [np.empty((y, m), dtype=dtype) for y in net.sizes[1:]]
+        self.activations = [np.empty((y, m), dtype=dtype)
+                            for y in net.sizes[1:]]
+        self.deltas = [np.empty((y, m), dtype=dtype) for y in net.sizes[1:]]
+        self.sp = [np.empty((y, m), dtype=dtype) for y in net.sizes[1:]]
+        self.mask = [np.empty((y, m), dtype=bool) for y in net.sizes[1:]]
+        self.nabla_b = [np.empty(b.shape, dtype=dtype) for b in net.biases]
+        self.nabla_w = [np.empty(w.shape, dtype=dtype) for w in net.weights]
+
+class DataParallel(object):
+    """Data-parallel training of ``net`` on the training set ``(X, Y)``
+    with ``processes`` worker processes.  The parameters, the training
+    set, the epoch's permutation and one gradient buffer per worker
+    live in shared memory: ``net.weights`` and ``net.biases`` are
+    replaced by views into it until ``close`` is called.  For each
+    mini-batch the workers backpropagate their share of the samples
+    straight into their gradient buffers, and the parent sums the
+    buffers and applies the update.  Up to the order of the floating
+    point reduction, this gives the same result as training in a
+    single process.
+    """
+    def __init__(self, net, X, Y, processes):
+        self.net = net
+        self.processes = processes
+        self.shm = []
+        dtype = net.dtype
+        shapes = [w.shape for w in net.weights] + \
+                 [b.shape for b in net.biases]
+        self.n_params = sum(int(np.prod(shape)) for shape in shapes)
+        params = self.share((self.n_params,), dtype)
+        self.grads = self.share((processes, self.n_params), dtype)
+        self.total = np.empty(self.n_params, dtype=dtype)
+        self.X = self.share(X.shape, X.dtype)
+        self.Y = self.share(Y.shape, Y.dtype)
+        self.index = self.share((len(X),), np.intp)
+        self.X[...], self.Y[...] = X, Y
+        views = unflatten(params, shapes)
+        for v, p in zip(views, net.weights + net.biases):
+            v[...] = p
+        L = len(net.weights)
+        net.weights, net.biases = views[:L], views[L:]
+        self.nabla = unflatten(self.total, shapes)
+        spec = {"network": type(net), "config": net.config(),
+                "sizes": net.sizes, "cost": net.cost, "dtype": dtype,
+                "params": (params.shm_name, params.shape),
+                "grads": (self.grads.shm_name, self.grads.shape),
+                "X": (self.X.shm_name, X.shape, X.dtype),
+                "Y": (self.Y.shm_name, Y.shape, Y.dtype),
+                "index": (self.index.shm_name, self.index.shape)}
+        self.conns, self.workers = [], []
+        for rank in range(processes):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=data_parallel_worker, args=(child_conn, spec, rank),
+                daemon=True)
+            worker.start()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+    def share(self, shape, dtype):
+        """Return a new array of ``shape`` and ``dtype`` backed by a
+        shared memory block, which is released by ``close``."""
+        size = max(int(np.prod(shape))*np.dtype(dtype).itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        self.shm.append(shm)
+        a = SharedArray(shape, dtype=dtype, buffer=shm.buf)
+        a.shm_name = shm.name
+        return a
+
+    def set_permutation(self, permutation):
+        """Publish the permutation of the training set for this epoch."""
+        self.index[...] = permutation
+
+    def update_mini_batch(self, start, stop, eta, lmbda, n):
+        """Train on the mini-batch made of the samples
+        ``permutation[start:stop]``, split evenly across the workers."""
+        bounds = np.linspace(start, stop, self.processes+1).astype(int)
+        rank = 0
+        try:
+            for rank, conn in enumerate(self.conns):
+                conn.send((int(bounds[rank]), int(bounds[rank+1])))
+            for rank, conn in enumerate(self.conns):
+                conn.recv()
+        except (EOFError, OSError):
+            # the worker's own traceback has been printed to stderr
+            self.workers[rank].join(timeout=1)
+            raise RuntimeError("DataParallel worker %d died (exit code %s)"
+                               % (rank, self.workers[rank].exitcode)) \
+                from None
+        np.sum(self.grads, axis=0, out=self.total)
+        if self.net.profiler is not None:
+            # forward and backward passes in the workers, and reduction
+            self.net.profiler.tick("workers")
+        L = len(self.net.weights)
+        self.net.update_parameters(self.nabla[L:], self.nabla[:L],
+                                   eta, lmbda, stop-start, n)
+
+    def close(self):
+        """Stop the workers, give ``net`` private copies of its
+        parameters and release the shared memory.  Safe to call after a
+        worker has died."""
+        try:
+            for conn in self.conns:
+                try:
+                    conn.send(None)
+                except OSError:
+                    # the worker is gone already (BrokenPipeError)
+                    pass
+            for worker in self.workers:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+            for conn in self.conns:
+                conn.close()
+            self.net.weights = [np.array(w) for w in self.net.weights]
+            self.net.biases = [np.array(b) for b in self.net.biases]
+        finally:
+            self.grads = self.total = self.nabla = None
+            self.X = self.Y = self.index = None
+            blocks, self.shm = self.shm, []
+            # unlinking only removes the names, so do it before close,
+            # which fails if views of a block are still alive
+            for shm in blocks:
+                shm.unlink()
+            for shm in blocks:
+                shm.close()
+
+class Profiler(object):
+    """Opt-in instrumentation of ``Network.SGD``.  For every epoch it
+    records the wall time and number of calls of each phase
+    (``shuffle``, ``gather``, ``forward``, ``backprop``, ``update``,
+    ``workers`` for data-parallel training, and ``monitoring``), the
+    training throughput in samples per second (monitoring excluded),
+    and, if ``trace_memory`` is set, the peak memory allocated during
+    the epoch as traced by ``tracemalloc`` (which slows training down
+    somewhat).  Each epoch's record is a dict, which is appended as one
+    JSON line to the file ``log`` (if given), passed to each of the
+    ``callbacks`` and kept in ``self.records``.
+    """
+    def __init__(self, log=None, callbacks=(), trace_memory=True):
+        self.log = log
+        self.callbacks = list(callbacks)
+        self.trace_memory = trace_memory
+        self.records = []
+        self.file = None
+        self.tracing = False
+
+    def begin_epoch(self):
+        self.times, self.calls = {}, {}
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            tracemalloc.reset_peak()
+        self.start = self.last = time.perf_counter()
+
+    def tick(self, phase):
+        """Charge the time since the previous tick to ``phase``."""
+        now = time.perf_counter()
+        self.times[phase] = self.times.get(phase, 0.0)+now-self.last
+        self.calls[phase] = self.calls.get(phase, 0)+1
+        self.last = now
+
+    def end_epoch(self, epoch, n):
+        """Finish the record of ``epoch``, in which ``n`` samples were
+        trained on, and hand it to the log and the callbacks."""
+        elapsed = time.perf_counter()-self.start
+        training = elapsed-self.times.get("monitoring", 0.0)
+        record = {"epoch": epoch, "time": elapsed,
+                  "samples_per_second": n/training if training > 0 else None,
+                  "phases": dict((phase, {"time": self.times[phase],
+                                          "calls": self.calls[phase]})
+                                 for phase in self.times)}
+        if self.trace_memory:
+            record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        self.records.append(record)
+        if self.log is not None:
+            if self.file is None:
+                self.file = open(self.log, "a")
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+        for callback in self.callbacks:
+            callback(record)
+
+    def close(self):
+        """Close the log and stop tracing memory if this profiler
+        started it.  Called by ``SGD`` when training ends."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+class SharedArray(np.ndarray):
+    """An ndarray that remembers the name of its shared memory block."""
+    shm_name = None
+
+def unflatten(flat, shapes):
+    """Return views of the 1-d array ``flat`` with the given shapes,
+    laid out one after the other."""
+    views, offset = [], 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        views.append(flat[offset:offset+size].reshape(shape))
+        offset += size
+    return views
+
+def data_parallel_worker(conn, spec, rank):
+    """Worker process of ``DataParallel``.  Receives ``(lo, hi)`` and
+    backpropagates the samples ``index[lo:hi]`` of the shared training
+    set into gradient buffer ``rank``, until it receives ``None``."""
+    blocks = []
+    def attach(name, shape, dtype):
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    dtype = spec["dtype"]
+    params = attach(*spec["params"], dtype=dtype)
+    grad = attach(*spec["grads"], dtype=dtype)[rank]
+    X, Y = attach(*spec["X"]), attach(*spec["Y"])
+    index = attach(*spec["index"], dtype=np.intp)
+    net = spec["network"](spec["sizes"], cost=spec["cost"], dtype=dtype,
+                          **spec["config"])
+    shapes = [w.shape for w in net.weights] + [b.shape for b in net.biases]
+    L = len(net.weights)
+    views = unflatten(params, shapes)
+    net.weights, net.biases = views[:L], views[L:]
+    nabla = unflatten(grad, shapes)
+    workspaces = {}
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        lo, hi = msg
+        if hi == lo:
+            grad[...] = 0
+        else:
+            if hi-lo not in workspaces:
+                # backpropagate straight into the shared gradient buffer
+                ws = Workspace(net, hi-lo, X.dtype, Y.dtype)
+                ws.nabla_w, ws.nabla_b = nabla[:L], nabla[L:]
+                workspaces[hi-lo] = ws
+            ws = workspaces[hi-lo]
+            np.take(X, index[lo:hi], axis=0, out=ws.x)
+            np.take(Y, index[lo:hi], axis=0, out=ws.y)
+            net.backprop_into(ws.x, ws.y, ws)
+        conn.send(True)
+    del params, grad, X, Y, index, views, nabla, workspaces, net
+    for shm in blocks:
+        shm.close()
 
 #### Loading a Network
-def load(filename):
+CHECKPOINT_VERSION = 1
+
+def load(filename, mmap_mode=None):
     """Load a neural network from the file ``filename``.  Returns an
-    instance of Network.
+    instance of Network.  Both the binary ``.npz`` checkpoints and the
+    legacy JSON files written by ``Network.save`` are understood; the
+    format is detected from the file contents.  For binary checkpoints
+    ``mmap_mode`` (``"r"``, ``"r+"`` or ``"c"``, as for ``np.load``)
+    memory-maps the parameters instead of reading them.  Note that
+    ``"r"`` gives read-only parameters, which can be used for
+    inference but not trained in place; use ``"c"`` for that.
     """
+    with open(filename, "rb") as f:
+        binary = f.read(4) == b"PK\x03\x04"
+    if binary:
+        with np.load(filename) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["format"] > CHECKPOINT_VERSION:
+                raise ValueError("checkpoint format {} of {} is newer than "
+                                 "this version ({})".format(
+                                     meta["format"], filename,
+                                     CHECKPOINT_VERSION))
+            names = ["w%d" % i for i in range(len(meta["sizes"])-1)] + \
+                    ["b%d" % i for i in range(len(meta["sizes"])-1)]
+            if mmap_mode is None:
+                params = [data[name] for name in names]
+            optimizer_state = dict((name[4:], data[name])
+                                   for name in data.files
+                                   if name.startswith("opt_"))
+        if mmap_mode is not None:
+            params = [npz_memmap(filename, name, mmap_mode)
+                      for name in names]
+        cost = getattr(sys.modules[__name__], meta["cost"])
+        network = getattr(sys.modules[__name__],
+                          meta.get("network", "Network"))
+        net = network(meta["sizes"], cost=cost, dtype=meta["dtype"],
+                      **meta.get("config", {}))
+        net.weights = params[:len(params)//2]
+        net.biases = params[len(params)//2:]
+        net.epoch = meta.get("epoch", 0)
+        if "optimizer" in meta:
+            optimizer = getattr(sys.modules[__name__],
+                                meta["optimizer"]["name"])
+            net.optimizer = optimizer(**meta["optimizer"]["config"])
+            net.optimizer.load_state(optimizer_state)
+        return net
     f = open(filename, "r")
     data = json.load(f)
     f.close()
     cost = getattr(sys.modules[__name__], data["cost"])
-    net = Network(data["sizes"], cost=cost)
-    net.weights = [np.array(w) for w in data["weights"]]
-    net.biases = [np.array(b) for b in data["biases"]]
+    # networks saved before the dtype option were trained in float64
+    dtype = np.dtype(data.get("dtype", "float64"))
+    net = Network(data["sizes"], cost=cost, dtype=dtype)
+    net.weights = [np.array(w, dtype=dtype) for w in data["weights"]]
+    net.biases = [np.array(b, dtype=dtype) for b in data["biases"]]
     return net
 
+def npz_memmap(filename, name, mode="r"):
+    """Memory-map the array ``name`` of the uncompressed ``.npz``
+    archive ``filename``.  ``np.load`` ignores ``mmap_mode`` for
+    archives, but the members written by ``np.savez`` are stored
+    uncompressed, so the array data can be mapped directly once the
+    zip and ``.npy`` headers in front of it have been skipped."""
+    with zipfile.ZipFile(filename) as zf:
+        info = zf.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("{} in {} is compressed and cannot be "
+                         "memory-mapped".format(name, filename))
+    with open(filename, "rb") as f:
+        # the local file header is 30 bytes, followed by the file name
+        # and the extra field, whose lengths are its last two fields
+        f.seek(info.header_offset)
+        name_len, extra_len = struct.unpack("<HH", f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=offset,
+                     shape=shape, order="F" if fortran_order else "C")
+
 #### Miscellaneous functions
 def vectorized_result(j):
     """Return a 2-dimensional unit vector with a 1.0 in the j'th position
@@ -301,13 +1449,35 @@ def vectorized_result(j):
     e[j] = 1.0
     return e
 
-def sigmoid(z):
-    """The sigmoid function."""
-    return 1.0/(1.0+np.exp(-z))
+def sigmoid(z, out=None, scratch=None, mask=None):
+    """The sigmoid function, evaluated in the sign-split form
+    ``1/(1+e)`` for ``z >= 0`` and ``e/(1+e)`` for ``z < 0`` with
+    ``e = exp(-|z|)``.  The exponential never overflows and the lower
+    tail keeps its full relative precision; the upper tail still
+    rounds to 1.0 once ``e`` is below the machine epsilon, which the
+    costs allow for.  If ``out`` is given, the result is written into
+    it; if the float array ``scratch`` and the boolean array ``mask``
+    of the same shape are given as well, no temporaries are
+    allocated."""
+    if out is None:
+        out = np.empty_like(z, dtype=np.result_type(z, 0.5))
+    if scratch is None:
+        scratch = np.empty_like(out)
+    if mask is None:
+        mask = np.empty(np.shape(z), dtype=bool)
+    np.greater_equal(z, 0, out=mask)
+    np.abs(z, out=out)
+    np.negative(out, out=out)
+    np.exp(out, out=out)
+    np.add(out, 1, out=scratch)
+    np.copyto(out, 1, where=mask)
+    out /= scratch
+    return out
 
 def sigmoid_prime(z):
     """Derivative of the sigmoid function."""
-    return sigmoid(z)*(1-sigmoid(z))
+    s = sigmoid(z)
+    return s*(1-s)
 
 def softmax(x):
     x_exp = np.exp(x)
@@ -315,9 +1485,79 @@ def softmax(x):
     return x_exp / x_exp_row_sum
 
 def load_data_wrapper(tr_d, tr_r, te_d, te_r):
-    training_data = list(zip(tr_d, [vectorized_result(y) for y in tr_r]))
-    test_data = list(zip(te_d, te_r))
-    return (training_data, test_data)
+    """Pack the generated lattices and labels into contiguous arrays.
+    Returns ``(training_data, test_data)``, where ``training_data`` is
+    a tuple ``(X, Y)`` with ``X`` of shape ``(N, L*L)`` and the one-hot
+    desired outputs ``Y`` of shape ``(N, 2)``, and ``test_data`` is a
+    tuple ``(X, y)`` with the integer labels ``y`` of shape ``(N,)``.
+    The arrays are stored in float32.
+    """
+    # the spins and one-hot outputs are exact in float32, which halves
+    # the size of the saved dataset and matches the default Network dtype
+    tr_X = np.reshape(tr_d, (len(tr_d), -1)).astype(np.float32)
+    te_X = np.reshape(te_d, (len(te_d), -1)).astype(np.float32)
+    tr_Y = np.eye(2, dtype=np.float32)[np.asarray(tr_r, dtype=int)]
+    te_y = np.asarray(te_r, dtype=int)
+    return ((tr_X, tr_Y), (te_X, te_y))
+
+def periodic_patch_index(L, k):
+    """Return the integer array ``(L*L, k*k)`` whose row ``i*L+j`` holds
+    the flat indices of the k x k patch centred on site ``(i, j)`` of
+    an L x L lattice with periodic boundary conditions."""
+    r = k//2
+    i, j = np.meshgrid(np.arange(L), np.arange(L), indexing="ij")
+    di, dj = np.meshgrid(np.arange(-r, k-r), np.arange(-r, k-r),
+                         indexing="ij")
+    rows = (i[:, :, None, None]+di) % L
+    columns = (j[:, :, None, None]+dj) % L
+    return (rows*L+columns).reshape(L*L, k*k)
+
+def iter_chunks(items, chunk_size, dtype=np.float64):
+    """Yield the inputs from the iterable ``items`` as arrays of at most
+    ``chunk_size`` rows.  Each item may be a single input (a row or
+    column vector) or a 2-D block with one input per row; the length
+    of the inputs is taken from the first item, so it need not match
+    the input layer of a network (a ``ConvNetwork`` accepts lattices
+    of any size).  The chunks are views of one reused buffer, so each
+    is only valid until the next one is requested."""
+    items = iter(items)
+    first = next(items, None)
+    if first is None:
+        return
+    first = np.asarray(first)
+    if first.ndim <= 1 or first.shape[-1] == 1:
+        n_in = first.size
+    else:
+        n_in = first.shape[-1]
+    buffer = np.empty((chunk_size, n_in), dtype=dtype)
+    filled = 0
+    for item in itertools.chain([first], items):
+        rows = np.reshape(item, (-1, n_in))
+        while len(rows):
+            k = min(chunk_size-filled, len(rows))
+            buffer[filled:filled+k] = rows[:k]
+            filled += k
+            rows = rows[k:]
+            if filled == chunk_size:
+                yield buffer
+                filled = 0
+    if filled:
+        yield buffer[:filled]
+
+def as_arrays(data):
+    """Return ``data`` as a tuple ``(X, Y)`` of arrays with one sample
+    per row.  ``data`` may already be such a tuple, or the legacy list
+    of ``(x, y)`` tuples with column-vector inputs, which is stacked
+    into contiguous arrays."""
+    if isinstance(data, tuple) and len(data) == 2 \
+            and isinstance(data[0], np.ndarray):
+        return data
+    xs, ys = zip(*data)
+    X = np.ascontiguousarray(np.reshape(xs, (len(xs), -1)))
+    Y = np.asarray(ys)
+    if Y.ndim > 1:
+        Y = np.ascontiguousarray(np.reshape(Y, (len(ys), -1)))
+    return (X, Y)
 
 def plot_fig(x, p0, p1, xlabel, title):
     fig = plt.figure()
@@ -336,6 +1576,279 @@ def plot_fig(x, p0, p1, xlabel, title):
     plt.title(title)
     plt.savefig("{}.png".format(title))
 
+#### Preprocessing
+class Preprocessor(object):
+    """Maps raw L x L lattices (one per row) to a few standardized
+    features for a small ``Network``: the ``n_components`` leading
+    principal components, fitted once by randomized PCA, and, if
+    ``physics`` is set, the physical observables of ``physics_features``
+    (|m|, the energy per site and ``structure_bins`` radial bins of the
+    structure factor).  Fit it on the training inputs, then train on
+    and predict from ``transform(X)``.  ``save`` and
+    ``load_preprocessor`` persist the fitted state.
+    """
+    def __init__(self, n_components=8, physics=True, structure_bins=4,
+                 oversamples=10, n_iter=2, seed=None):
+        self.n_components = n_components
+        self.physics = physics
+        self.structure_bins = structure_bins
+        self.oversamples = oversamples
+        self.n_iter = n_iter
+        self.seed = seed
+        self.mean = self.components = None
+        self.shift = self.scale = None
+
+    def fit(self, X):
+        """Fit the PCA and the standardization on the rows of ``X``."""
+        X = np.asarray(X, dtype=np.float64)
+        if self.n_components:
+            self.mean, self.components = randomized_pca(
+                X, self.n_components, self.oversamples, self.n_iter,
+                np.random.RandomState(self.seed))
+        F = self.features(X)
+        self.shift = F.mean(axis=0)
+        self.scale = F.std(axis=0)
+        self.scale[self.scale == 0] = 1.0
+        return self
+
+    def features(self, X):
+        """Return the raw (unstandardized) features of the rows of
+        ``X``."""
+        features = []
+        if self.n_components:
+            features.append(np.dot(X-self.mean, self.components.T))
+        if self.physics:
+            features.append(physics_features(X, self.structure_bins))
+        return np.hstack(features)
+
+    def transform(self, X, chunk_size=10000, dtype=np.float32):
+        """Return the standardized features, one row per row of ``X``,
+        computed ``chunk_size`` rows at a time."""
+        F = [(self.features(np.asarray(X[k:k+chunk_size], dtype=np.float64))
+              -self.shift)/self.scale
+             for k in range(0, len(X), chunk_size)]
+        return np.concatenate(F).astype(dtype) if F else \
+            np.empty((0, len(self.shift)), dtype=dtype)
+
+    def fit_transform(self, X, **kwargs):
+        return self.fit(X).transform(X, **kwargs)
+
+    def save(self, filename):
+        """Save the fitted preprocessor to the ``.npz`` file
+        ``filename``."""
+        meta = {"n_components": self.n_components, "physics": self.physics,
+                "structure_bins": self.structure_bins,
+                "oversamples": self.oversamples, "n_iter": self.n_iter,
+                "seed": self.seed}
+        arrays = {"shift": self.shift, "scale": self.scale,
+                  "meta": np.array(json.dumps(meta))}
+        if self.n_components:
+            arrays["mean"], arrays["components"] = self.mean, self.components
+        with open(filename, "wb") as f:
+            np.savez(f, **arrays)
+
+def load_preprocessor(filename):
+    """Load a ``Preprocessor`` saved by ``Preprocessor.save``."""
+    with np.load(filename) as data:
+        pre = Preprocessor(**json.loads(str(data["meta"])))
+        pre.shift, pre.scale = data["shift"], data["scale"]
+        if pre.n_components:
+            pre.mean, pre.components = data["mean"], data["components"]
+    return pre
+
+def randomized_pca(X, k, oversamples=10, n_iter=2, rng=np.random):
+    """Return ``(mean, components)``, the mean of the rows of ``X`` and
+    its ``k`` leading principal axes as the rows of ``components``,
+    computed by the randomized range finder of Halko, Martinsson and
+    Tropp with ``n_iter`` power iterations.  Only products of ``X``
+    with thin matrices are needed, instead of a full SVD."""
+    mean = X.mean(axis=0)
+    Xc = X-mean
+    Q = np.linalg.qr(np.dot(Xc, rng.randn(X.shape[1], k+oversamples)))[0]
+    for i in range(n_iter):
+        Q = np.linalg.qr(np.dot(Xc.T, Q))[0]
+        Q = np.linalg.qr(np.dot(Xc, Q))[0]
+    Vt = np.linalg.svd(np.dot(Q.T, Xc), full_matrices=False)[2]
+    return mean, Vt[:k]
+
+def physics_features(X, structure_bins=4):
+    """Return, for each L x L lattice of +-1 spins in the rows of
+    ``X``, the absolute magnetization |m|, the energy per site
+    E/N = -sum_<ij> s_i s_j / N (J = 1, periodic boundaries) and the
+    structure factor S(q) = |sum_r s_r exp(iqr)|^2/N averaged over
+    ``structure_bins`` shells of |q| > 0, all computed for the whole
+    batch at once."""
+    N = X.shape[1]
+    L = int(round(np.sqrt(N)))
+    s = np.reshape(X, (-1, L, L))
+    m = np.abs(s.mean(axis=(1, 2)))
+    energy = -np.mean(s*(np.roll(s, 1, axis=1)+np.roll(s, 1, axis=2)),
+                      axis=(1, 2))
+    S = (np.abs(np.fft.fft2(s))**2/N).reshape(len(s), N)
+    q = 2*np.pi*np.fft.fftfreq(L)
+    q = np.sqrt(q[:, None]**2+q[None, :]**2).ravel()
+    shells = np.minimum((q/q.max()*structure_bins).astype(int),
+                        structure_bins-1)
+    shells[0] = -1 # q = 0 is m^2*N, already covered by |m|
+    averages = np.stack([(shells == b)/max(np.sum(shells == b), 1)
+                         for b in range(structure_bins)], axis=1)
+    return np.column_stack([m, energy, np.dot(S, averages)])
+
+def benchmark_optimizers(training_data, evaluation_data, optimizers,
+                         epochs=10, hidden=30, mini_batch_size=10,
+                         lmbda=5.0, title="Ising_optimizers"):
+    """Train a fresh ``Network`` for each entry ``label: (optimizer,
+    eta)`` of the dict ``optimizers`` (``optimizer`` may be None for
+    plain gradient descent, ``eta`` may be a schedule), and plot the
+    accuracy on ``evaluation_data`` after every epoch against the
+    wall-clock training time to ``{title}.png``.  The time spent on
+    evaluation is not counted.  Returns a dict ``label: (times,
+    accuracies)``."""
+    n_in, n_data = training_data[0].shape[1], len(evaluation_data[0])
+    results = {}
+    for label, (optimizer, eta) in optimizers.items():
+        net = Network([n_in, hidden, 2])
+        times, accuracies, elapsed = [], [], 0.0
+        for j in range(epochs):
+            start = time.time()
+            net.SGD(training_data, 1, mini_batch_size, eta, lmbda=lmbda,
+                    optimizer=optimizer)
+            elapsed += time.time()-start
+            times.append(elapsed)
+            accuracies.append(net.evaluate(evaluation_data)[1]/n_data)
+        results[label] = (times, accuracies)
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    for label, (times, accuracies) in results.items():
+        ax.plot(times, accuracies, '-o', label=label)
+    ax.legend(loc=4)
+    ax.grid()
+    ax.set_xlabel("training time (s)")
+    ax.set_ylabel("evaluation accuracy")
+    plt.title(title)
+    plt.savefig("{}.png".format(title))
+    return results
+
+#### Hyperparameter sweeps
+sweep_data = {}
+
+def sweep_init(dataset):
+    """Initializer of the ``sweep`` worker processes: memory-map the
+    training and test arrays of the ``.npz`` file ``dataset``
+    read-only.  All workers share the same pages of the file."""
+    sweep_data["training"] = (npz_memmap(dataset, "tr_X"),
+                              npz_memmap(dataset, "tr_Y"))
+    sweep_data["evaluation"] = (npz_memmap(dataset, "te_X"),
+                                npz_memmap(dataset, "te_y"))
+
+def sweep_trial(task):
+    """Train trial ``(trial, config, epochs, checkpoint)`` of ``sweep``
+    up to ``epochs`` epochs in total, resuming from ``checkpoint`` if
+    it exists, and return its result record."""
+    trial, config, epochs, checkpoint = task
+    X, Y = sweep_data["training"]
+    if os.path.exists(checkpoint):
+        net = load(checkpoint)
+    else:
+        np.random.seed(config.get("seed", trial))
+        hidden = config.get("hidden", 30)
+        hidden = list(hidden) if isinstance(hidden, (list, tuple)) else [hidden]
+        # in the dtype of the data, so that SGD uses the memory map as is
+        net = Network([X.shape[1]] + hidden + [Y.shape[1]], dtype=X.dtype)
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        net.SGD(sweep_data["training"], epochs-net.epoch,
+                config.get("mini_batch_size", 10), config.get("eta", 1.0),
+                lmbda=config.get("lmbda", 0.0))
+    elapsed = time.time()-start
+    cost, accuracy = net.evaluate(sweep_data["evaluation"],
+                                  config.get("lmbda", 0.0))
+    net.save(checkpoint)
+    return {"trial": trial, "config": config, "epochs": epochs,
+            "evaluation_cost": cost,
+            "evaluation_accuracy": accuracy/len(sweep_data["evaluation"][0]),
+            "time": elapsed}
+
+def sample_space(space, n_trials=None, seed=None):
+    """Return the list of configurations (dicts) of a search ``space``,
+    a dict mapping each hyperparameter of ``sweep_trial`` (``hidden``,
+    ``eta``, ``lmbda``, ``mini_batch_size``, ``seed``) to its values.
+    Without ``n_trials`` this is the full grid over the lists of
+    values.  Otherwise ``n_trials`` random configurations are drawn: a
+    list is sampled uniformly and a tuple ``(low, high)`` log-uniformly.
+    """
+    names = sorted(space)
+    if n_trials is None:
+        return [dict(zip(names, values))
+                for values in itertools.product(*[space[name]
+                                                  for name in names])]
+    rng = np.random.RandomState(seed)
+    configs = []
+    for i in range(n_trials):
+        config = {}
+        for name in names:
+            values = space[name]
+            if isinstance(values, tuple):
+                config[name] = float(np.exp(rng.uniform(np.log(values[0]),
+                                                        np.log(values[1]))))
+            else:
+                config[name] = values[rng.randint(len(values))]
+        configs.append(config)
+    return configs
+
+def sweep(dataset, space, n_trials=None, min_epochs=1, max_epochs=27,
+          reduction=3, processes=None, results="Ising_sweep.jsonl",
+          workdir="Ising_sweep", seed=None):
+    """Search the hyperparameters of a ``Network`` on the dataset saved
+    in the ``.npz`` file ``dataset`` (arrays ``tr_X``, ``tr_Y``,
+    ``te_X``, ``te_y``, as written by the script), running the trials
+    in a pool of ``processes`` worker processes that all memory-map the
+    same file.  The configurations come from ``sample_space(space,
+    n_trials, seed)``.  Trials are cut by successive halving: all of
+    them are trained for ``min_epochs`` epochs, then the best
+    ``1/reduction`` of them, by evaluation accuracy, are continued to
+    ``reduction`` times as many epochs, and so on up to ``max_epochs``.
+    Every result is appended as a JSON line to ``results`` as soon as
+    it arrives, and the networks are kept as checkpoints in a new
+    subdirectory of ``workdir`` for this call, so that trials of an
+    earlier sweep are never resumed; its name is stored as ``sweep`` in
+    every record.  Returns the records of the last rung, best first.
+    """
+    configs = sample_space(space, n_trials, seed)
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    rundir = tempfile.mkdtemp(prefix=time.strftime("sweep_%Y%m%d_%H%M%S_"),
+                              dir=workdir)
+    sweep_id = os.path.basename(rundir)
+    trials = list(range(len(configs)))
+    epochs = min_epochs
+    pool = multiprocessing.Pool(processes, initializer=sweep_init,
+                                initargs=(dataset,))
+    try:
+        with open(results, "a") as f:
+            while True:
+                tasks = [(trial, configs[trial], epochs,
+                          os.path.join(rundir, "trial_%d.npz" % trial))
+                         for trial in trials]
+                records = []
+                for record in pool.imap_unordered(sweep_trial, tasks):
+                    record["sweep"] = sweep_id
+                    records.append(record)
+                    f.write(json.dumps(record) + "\n")
+                    f.flush()
+                    print("Trial {trial}, {epochs} epochs: accuracy "
+                          "{evaluation_accuracy:.4f}, config {config}"
+                          .format(**record))
+                records.sort(key=lambda record: -record["evaluation_accuracy"])
+                if epochs >= max_epochs or len(records) <= 1:
+                    return records
+                keep = max(1, len(records)//reduction)
+                trials = [record["trial"] for record in records[:keep]]
+                epochs = min(epochs*reduction, max_epochs)
+    finally:
+        pool.close()
+        pool.join()
+
 
 """
 Ising model sample generator
@@ -372,12 +1885,28 @@ def modpbc(x, L=28):
 
 if __name__ == "__main__":
     train = False
+    benchmark = False
+    conv = False # convolutional first layer instead of 784x30 weights
+    preprocess = False # train on PCA and physics features instead of raw lattices
+    search = False # hyperparameter sweep on the saved dataset
 
     # Ising model: T < Tc: label 0, T > Tc: label 1
     print("Ising model: T < Tc: label 0, T > Tc: label 1")
     # load or generate dataset
-    if os.path.exists("Ising_dataset.npy"):
+    if os.path.exists("Ising_dataset.npz"):
+        with np.load("Ising_dataset.npz") as f:
+            training_data = (f["tr_X"], f["tr_Y"])
+            test_data = (f["te_X"], f["te_y"])
+    elif os.path.exists("Ising_dataset.npy"):
+        # datasets generated by earlier versions: lists of (x, y) tuples
         training_data, test_data = np.load("Ising_dataset.npy", allow_pickle=True)
+        training_data, test_data = as_arrays(training_data), as_arrays(test_data)
+        # stored like a freshly generated dataset, see load_data_wrapper
+        training_data = tuple(a.astype(np.float32) for a in training_data)
+        test_data = (test_data[0].astype(np.float32), test_data[1])
+        np.savez("Ising_dataset.npz", tr_X=training_data[0], tr_Y=training_data[1],
+                 te_X=test_data[0], te_y=test_data[1])
+        print("Converted Ising_dataset.npy to Ising_dataset.npz")
     else:
         train_count, test_count = 40000, 4000
         tr_d, tr_r, te_d, te_r, group = [], [], [], [], 100
@@ -394,24 +1923,56 @@ if __name__ == "__main__":
             te_d += generate_Ising_data(group, T=1.3 * random.random() + 1.2)
             te_r += group * [1]
         training_data, test_data = load_data_wrapper(tr_d, tr_r, te_d, te_r)
-        np.save("Ising_dataset.npy", np.array((training_data, test_data), dtype=object))
+        np.savez("Ising_dataset.npz", tr_X=training_data[0], tr_Y=training_data[1],
+                 te_X=test_data[0], te_y=test_data[1])
         print("Datasets generation finished!")
-    print("len(training_data)={},\tlen(test_data)={}".format(len(training_data), len(test_data)))
+    print("len(training_data)={},\tlen(test_data)={}".format(len(training_data[0]), len(test_data[0])))
+    if search:
+        sweep("Ising_dataset.npz", {"hidden": [10, 30, 100], "eta": (0.05, 2.0),
+                                    "lmbda": (0.1, 10.0), "mini_batch_size": [10, 50]},
+              n_trials=27, min_epochs=1, max_epochs=27)
+    checkpoint = "Ising_ANN.npz"
+    if preprocess:
+        if os.path.exists("Ising_preprocessor.npz"):
+            pre = load_preprocessor("Ising_preprocessor.npz")
+        else:
+            pre = Preprocessor(n_components=8).fit(training_data[0])
+            pre.save("Ising_preprocessor.npz")
+        training_data = (pre.transform(training_data[0]), training_data[1])
+        test_data = (pre.transform(test_data[0]), test_data[1])
+        checkpoint = "Ising_ANN_features.npz"
     # train & test
-    if os.path.exists("Ising_ANN.pkl") and not train:
+    if os.path.exists(checkpoint) and not train:
+        net = load(checkpoint)
+    elif os.path.exists("Ising_ANN.pkl") and not train and not preprocess:
+        # networks saved by earlier versions, in the legacy JSON format
         net = load("Ising_ANN.pkl")
     else:
-        net = Network([training_data[0][0].shape[0], 30, 2])
+        if conv:
+            net = ConvNetwork([training_data[0].shape[1], 8, 30, 2], kernel_size=3)
+        else:
+            net = Network([training_data[0].shape[1], 30, 2])
         # net.large_weight_initializer()
         net.SGD(training_data, 100, 10, 1.0, lmbda=5.0, evaluation_data=test_data, monitor_evaluation_accuracy=True,
-                monitor_evaluation_cost=True, monitor_training_accuracy=True, monitor_training_cost=True)
-        net.save('Ising_ANN.pkl')
+                monitor_evaluation_cost=True, monitor_training_accuracy=True, monitor_training_cost=True,
+                early_stopping="evaluation_accuracy", patience=10)
+        net.save(checkpoint)
         print("Training finished!\n\n")
+    if benchmark:
+        # accuracy vs. wall-clock time of the optimizers on the same task
+        benchmark_optimizers(training_data, test_data, {
+            "SGD": (None, 1.0),
+            "Momentum": (Momentum(0.9), 0.1),
+            "Nesterov": (Momentum(0.9, nesterov=True), 0.1),
+            "Adam + cosine": (Adam(), Warmup(CosineDecay(1e-3, 20), 1)),
+        }, epochs=20)
     # plot phase diagram
     Tem, p0, p1, group = np.arange(0.1, 2.51, 0.1), [], [], 10
     for t in Tem:
-        samples = np.concatenate(generate_Ising_data(group, T=t), axis=1)
-        output = net.feedforward(samples)
-        p0.append(np.mean(output[0]))
-        p1.append(np.mean(output[1]))
+        samples = generate_Ising_data(group, T=t)
+        if preprocess:
+            samples = pre.transform(np.reshape(samples, (group, -1)))
+        proba, labels = net.predict_proba(samples)
+        p0.append(np.mean(proba[:, 0]))
+        p1.append(np.mean(proba[:, 1]))
     plot_fig(Tem, p0, p1, "T", "Ising")